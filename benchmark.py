@@ -0,0 +1,177 @@
+'''
+Selection throughput of the strategies.
+
+Runs short learning curves over a synthetic sparse data set (configurable size, density and
+class balance) for every strategy and classifier, and reports the mean latency of chooseNext
+and the steps per second of the whole loop, as measured by the phase timers. Results can be
+saved as a JSON baseline and compared against a later run to spot regressions:
+
+    python benchmark.py -o baseline.json
+    python benchmark.py -cmp baseline.json
+'''
+
+import argparse
+import json
+import sys
+import numpy as np
+import scipy.sparse as ss
+
+from time import time
+
+from sklearn.naive_bayes import MultinomialNB, GaussianNB, BernoulliNB
+from sklearn.ensemble import RandomForestClassifier, AdaBoostClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.svm import SVC
+from sklearn.tree import DecisionTreeClassifier
+
+from learning_curve import learningTrial
+from timing import timers
+
+
+STRATEGIES = ['rand', 'unc', 'qbc', 'loggain', 'erreduct', 's1', 's2', 'sim']
+
+CLASSIFIERS = ['MultinomialNB', 'BernoulliNB', 'GaussianNB', 'LogisticRegression', 'SVC', 'KNeighborsClassifier',
+               'DecisionTreeClassifier', 'RandomForestClassifier', 'AdaBoostClassifier']
+
+# Arguments the classifiers need to be usable by every strategy
+CLASSIFIER_ARGS = {'SVC': {'probability': True}}
+
+
+"""
+Synthetic counts in svmlight form: a CSR matrix of non-negative integers with the given
+density, and binary labels with a share `balance` of positives. Each class draws its
+counts from its own half of the informative features, so the classes can be learnt.
+"""
+def syntheticData(num_instances, num_features, density=0.01, balance=0.5, seed=0):
+    randgen = np.random.RandomState(seed)
+
+    y = (randgen.rand(num_instances) < balance).astype(np.float64)
+
+    X = ss.random(num_instances, num_features, density=density, format='csr', random_state=randgen,
+                  data_rvs=lambda k: randgen.randint(1, 4, size=k)).tolil()
+
+    informative = max(num_features / 10, 2)
+    for i in xrange(num_instances):
+        half = informative / 2
+        offset = 0 if y[i] == 0 else half
+        for j in randgen.randint(offset, offset + half, size=max(int(density * num_features), 1)):
+            X[i, j] += 1
+
+    return X.tocsr(), y
+
+
+"""
+Runs `trials` learning curves of strategy with classifier and returns the mean chooseNext
+latency (ms), the number of chooseNext calls and the steps per second of the loop.
+"""
+def benchmarkStrategy(strategy, classifier, X_pool, y_pool, X_test, y_test, budget, step_size, sub_pool, bootstrap, trials=1):
+    s_parameter = 'log'
+    if strategy == 'sim':
+        s_parameter = ['s1', 's2', 0.9, 0.1]
+    alpha = CLASSIFIER_ARGS.get(classifier.__name__, {})
+
+    timers.reset()
+    steps = 0
+    t0 = time()
+    for t in range(trials):
+        curve = learningTrial(t, X_pool, y_pool, X_test, strategy, budget, step_size, sub_pool, bootstrap, classifier, alpha, y_test, 0, s_parameter, False)
+        steps += len(curve)
+    duration = time() - t0
+
+    phase = timers.snapshot().get('chooseNext', {'time': 0.0, 'calls': 0})
+    latency = 1000. * phase['time'] / max(phase['calls'], 1)
+    return {'chooseNext_ms': latency, 'calls': phase['calls'], 'steps_per_sec': steps / duration}
+
+
+"""
+Differences against a baseline: entries slower than it by more than tolerance (a fraction).
+"""
+def compare(baseline, current, tolerance):
+    regressions = []
+    for key in sorted(current):
+        if not key in baseline:
+            continue
+        old = baseline[key]
+        new = current[key]
+        if new['chooseNext_ms'] > old['chooseNext_ms'] * (1 + tolerance) or new['steps_per_sec'] * (1 + tolerance) < old['steps_per_sec']:
+            regressions.append(key)
+    return regressions
+
+
+if (__name__ == '__main__'):
+
+    parser = argparse.ArgumentParser(description='Benchmarks chooseNext latency and steps per second of the strategies.')
+
+    parser.add_argument("-st", "--strategies", choices=STRATEGIES, nargs='*', default=STRATEGIES,
+                        help="Strategies to benchmark (default: all).")
+
+    parser.add_argument("-c", "--classifiers", choices=CLASSIFIERS, nargs='*', default=['MultinomialNB', 'BernoulliNB', 'LogisticRegression'],
+                        help="Classifiers to benchmark (default: MultinomialNB BernoulliNB LogisticRegression).")
+
+    # Synthetic data
+    parser.add_argument("-n", "--instances", default=2000, type=int, help="Instances in the pool (default: 2000).")
+    parser.add_argument("-nte", "--test_instances", default=1000, type=int, help="Instances in the test set (default: 1000).")
+    parser.add_argument("-nf", "--features", default=5000, type=int, help="Number of features (default: 5000).")
+    parser.add_argument("-de", "--density", default=0.01, type=float, help="Share of non-zero features (default: 0.01).")
+    parser.add_argument("-ba", "--balance", default=0.5, type=float, help="Share of positive instances (default: 0.5).")
+
+    # Learning curve
+    parser.add_argument("-nt", "--num_trials", default=1, type=int, help="Number of trials per benchmark (default: 1).")
+    parser.add_argument("-bs", '--bootstrap', default=10, type=int, help='Sets the Boot strap (default: 10).')
+    parser.add_argument("-b", '--budget', default=60, type=int, help='Sets the budget (default: 60).')
+    parser.add_argument("-sz", '--stepsize', default=10, type=int, help='Sets the step size (default: 10).')
+    parser.add_argument("-sp", '--subpool', default=50, type=int, help='Sets the sub pool size (default: 50).')
+
+    # Baselines
+    parser.add_argument("-o", "--output", type=str, default='',
+                        help='File the results are saved to as a JSON baseline (default: '' ).')
+    parser.add_argument("-cmp", "--compare", type=str, default='',
+                        help='Baseline to compare against; exits with status 1 if any benchmark regressed (default: '' ).')
+    parser.add_argument("-tol", "--tolerance", default=0.2, type=float,
+                        help='Slowdown tolerated by --compare, as a fraction (default: 0.2).')
+
+    args = parser.parse_args()
+
+    config = {'instances': args.instances, 'test_instances': args.test_instances, 'features': args.features, 'density': args.density,
+              'balance': args.balance, 'num_trials': args.num_trials, 'bootstrap': args.bootstrap, 'budget': args.budget,
+              'stepsize': args.stepsize, 'subpool': args.subpool}
+
+    X_pool, y_pool = syntheticData(args.instances, args.features, args.density, args.balance, seed=0)
+    X_test, y_test = syntheticData(args.test_instances, args.features, args.density, args.balance, seed=1)
+
+    results = {}
+    for name in args.classifiers:
+        # name is a string, eval makes it a class
+        classifier = eval(name)
+        for strategy in args.strategies:
+            key = '%s/%s' % (strategy, name)
+            results[key] = benchmarkStrategy(strategy, classifier, X_pool, y_pool, X_test, y_test, args.budget, args.stepsize, args.subpool, args.bootstrap, args.num_trials)
+
+    print
+    print "%-36s%16s%16s" % ('Benchmark', 'chooseNext (ms)', 'Steps/s')
+    for key in sorted(results):
+        print "%-36s%16.3f%16.3f" % (key, results[key]['chooseNext_ms'], results[key]['steps_per_sec'])
+
+    if args.output:
+        with open(args.output, 'w') as doc:
+            json.dump({'config': config, 'results': results}, doc, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as doc:
+            baseline = json.load(doc)
+
+        if baseline['config'] != config:
+            print
+            print "Warning: the baseline was run with different settings: %s" % baseline['config']
+
+        regressions = compare(baseline['results'], results, args.tolerance)
+        print
+        if regressions:
+            print "Regressions (more than %d%% slower than %s):" % (100 * args.tolerance, args.compare)
+            for key in regressions:
+                old = baseline['results'][key]
+                new = results[key]
+                print "%-36s%10.3f -> %0.3f ms\t%10.3f -> %0.3f steps/s" % (key, old['chooseNext_ms'], new['chooseNext_ms'], old['steps_per_sec'], new['steps_per_sec'])
+            sys.exit(1)
+        print "No regressions against %s." % args.compare
@@ -0,0 +1,46 @@
+'''
+Per-trial checkpoints of learning-curve runs.
+
+After every step of a trial the state needed to continue it (train indices, pool, global RNG
+state, strategy state and the curve measured so far) is pickled to
+<directory>/<strategy>-trial<t>.pkl, so an interrupted run can be resumed from its last
+completed step and produce the same results.
+'''
+
+import cPickle
+import os
+
+from datacache import atomicWrite
+
+
+class TrialCheckpoint(object):
+
+    def __init__(self, directory, strategy, trial, config):
+        self.directory = directory
+        self.path = os.path.join(directory, '%s-trial%d.pkl' % (strategy, trial))
+        # settings of the run, a checkpoint of a different run is never resumed
+        self.config = config
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+
+        with open(self.path, 'rb') as f:
+            state = cPickle.load(f)
+
+        if state['config'] != self.config:
+            raise ValueError("Checkpoint %s was written by a run with different settings: %s" % (self.path, state['config']))
+        return state
+
+    def save(self, state):
+        state = dict(state)
+        state['config'] = self.config
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # a crash while saving keeps the previous checkpoint
+        def dumpState(tmp):
+            with open(tmp, 'wb') as f:
+                cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+        atomicWrite(self.path, dumpState)
@@ -0,0 +1,102 @@
+'''
+Binary on-disk cache of svmlight files.
+
+The first load of a file parses it with load_svmlight_file and stores the CSR arrays
+(data, indices, indptr) and the labels as .npy files; later loads memory-map them.
+Entries are keyed by the file's absolute path, size and modification time (and the
+requested number of features), so an edited file is parsed again.
+'''
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.sparse as ss
+
+from sklearn.datasets import load_svmlight_file
+
+
+"""
+Writes path by calling write on a temporary file (or, with directory, a temporary directory)
+next to it, then renaming it over path, so a concurrent or interrupted run never sees a
+partial file. A directory made meanwhile by another run is kept instead.
+"""
+def atomicWrite(path, write, directory=False):
+    parent = os.path.dirname(path) or '.'
+    if directory:
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.')
+    else:
+        fd, tmp = tempfile.mkstemp(dir=parent, prefix='.')
+        os.close(fd)
+
+    try:
+        write(tmp)
+        os.rename(tmp, path)
+    except OSError:
+        if not (directory and os.path.isdir(path)):
+            raise
+    finally:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        elif os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def saveCSR(directory, X, y=None):
+    X = ss.csr_matrix(X)
+    X.sort_indices()
+    np.save(os.path.join(directory, 'data.npy'), X.data)
+    np.save(os.path.join(directory, 'indices.npy'), X.indices)
+    np.save(os.path.join(directory, 'indptr.npy'), X.indptr)
+    np.save(os.path.join(directory, 'shape.npy'), np.array(X.shape))
+    if y is not None:
+        np.save(os.path.join(directory, 'labels.npy'), np.asarray(y))
+
+"""
+Loads a matrix written by saveCSR. With mmap the arrays are memory-mapped read-only,
+so the matrix is only paged in as it is used and is shared by every process mapping it.
+"""
+def loadCSR(directory, mmap=True):
+    mmap_mode = 'r' if mmap else None
+    data = np.load(os.path.join(directory, 'data.npy'), mmap_mode=mmap_mode)
+    indices = np.load(os.path.join(directory, 'indices.npy'), mmap_mode=mmap_mode)
+    indptr = np.load(os.path.join(directory, 'indptr.npy'), mmap_mode=mmap_mode)
+    shape = tuple(np.load(os.path.join(directory, 'shape.npy')))
+    X = ss.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+    y = None
+    if os.path.exists(os.path.join(directory, 'labels.npy')):
+        y = np.load(os.path.join(directory, 'labels.npy'), mmap_mode=mmap_mode)
+    return X, y
+
+
+def cacheKey(path, n_features=None):
+    stat = os.stat(path)
+    key = '%s|%d|%r|%s' % (os.path.abspath(path), stat.st_size, stat.st_mtime, n_features)
+    return hashlib.sha1(key).hexdigest()
+
+def cachePath(path, cache_dir, n_features=None):
+    return os.path.join(cache_dir, '%s-%s' % (os.path.basename(path), cacheKey(path, n_features)))
+
+
+"""
+Same as load_svmlight_file(path, n_features=n_features), reading from (and filling) the
+binary cache in cache_dir.
+"""
+def loadSvmlightCached(path, cache_dir, n_features=None):
+    entry = cachePath(path, cache_dir, n_features)
+
+    if not os.path.isdir(entry):
+        if n_features is None:
+            X, y = load_svmlight_file(path)
+        else:
+            X, y = load_svmlight_file(path, n_features=n_features)
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        atomicWrite(entry, lambda tmp: saveCSR(tmp, X, y), directory=True)
+
+    return loadCSR(entry)
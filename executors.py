@@ -0,0 +1,76 @@
+'''
+Executors used to score independent candidates concurrently.
+
+All executors expose map(func, items), returning [func(item) for item in items] in order,
+so the utilities they produce are the same as the ones of the serial loop.
+Classifiers that draw from the global numpy RNG (e.g. SVC or LogisticRegression without
+random_state) consume it in a different order when run concurrently; pass random_state
+through the classifier's arguments to keep those runs reproducible.
+'''
+
+import os
+from multiprocessing import Pool, current_process
+from multiprocessing.pool import ThreadPool
+
+
+class SerialExecutor(object):
+
+    def map(self, func, items):
+        return [func(item) for item in items]
+
+
+class ThreadExecutor(object):
+
+    def __init__(self, n_jobs):
+        self.n_jobs = n_jobs
+        self.pool = None
+        self.pid = None
+
+    def map(self, func, items):
+        # Threads do not survive a fork, so each process builds its own pool
+        if self.pool is None or self.pid != os.getpid():
+            self.pool = ThreadPool(self.n_jobs)
+            self.pid = os.getpid()
+        return self.pool.map(func, items)
+
+
+# Function being mapped by ProcessExecutor, inherited by its forked workers
+_task = None
+
+def _runTask(item):
+    return _task(item)
+
+class ProcessExecutor(object):
+
+    def __init__(self, n_jobs):
+        self.n_jobs = n_jobs
+
+    def map(self, func, items):
+        global _task
+        items = list(items)
+
+        # Workers of a process pool (e.g. learning_curve --jobs) cannot fork their own
+        if len(items) < 2 or current_process().daemon:
+            return [func(item) for item in items]
+
+        # The workers are forked after _task is set, so func and the data it closes over
+        # (training matrix, test set) are shared with them instead of being pickled
+        _task = func
+        workers = Pool(processes=min(self.n_jobs, len(items)))
+        try:
+            chunksize = max(1, len(items) / (4 * self.n_jobs))
+            return workers.map(_runTask, items, chunksize=chunksize)
+        finally:
+            workers.close()
+            workers.join()
+            _task = None
+
+
+def makeExecutor(kind='serial', n_jobs=1):
+    if kind == 'serial' or n_jobs <= 1:
+        return SerialExecutor()
+    elif kind == 'thread':
+        return ThreadExecutor(n_jobs)
+    elif kind == 'process':
+        return ProcessExecutor(n_jobs)
+    raise ValueError("Unknown executor: %s" % kind)
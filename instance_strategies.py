@@ -1,12 +1,38 @@
-import math
+import heapq
 import numpy as np
 import sys
-from collections import defaultdict
 from sklearn import metrics
 import scipy.sparse as ss
+from scipy.stats import norm
 
 from sklearn.naive_bayes import GaussianNB
 
+from executors import SerialExecutor, ThreadExecutor
+from pools import IndexPool
+from timing import timers
+from trainingbuffer import TrainingBuffer
+from lookahead import ENGINES, NBLookahead, WarmStarter, checkLookahead, lookaheadEngine
+from utilities import TINY, log_gain, expected_log_loss, utility, uncertainty, vote_entropy, kl_disagreement
+
+# Lookahead modes of the strategies that fit hypothetical training sets, the others ignore it
+STRATEGY_LOOKAHEADS = {'loggain': ['refit', 'nb', 'warm', 'influence'], 'erreduct': ['refit', 'nb', 'warm', 'influence'],
+                       's1': ['refit', 'nb', 'warm', 'influence'], 's2': ['refit', 'nb', 'warm']}
+
+# Lookahead modes of the swaps of makeItBetter
+MAKEITBETTER_LOOKAHEADS = ['refit', 'nb']
+
+"""
+Draws num_candidates random instances from the pool. An IndexPool samples them in O(k);
+other containers (lists of candidates, sets) are shuffled as a whole.
+"""
+def sampleCandidates(pool, num_candidates, randgen):
+    with timers.phase('sampling'):
+        if isinstance(pool, IndexPool):
+            return pool.sample(num_candidates, randgen).tolist()
+        list_pool = list(pool)
+        rand_indices = randgen.permutation(len(pool))
+        return [list_pool[i] for i in rand_indices[:num_candidates]]
+
 class RandomBootstrap(object):
     def __init__(self, seed):
         self.randS = RandomStrategy(seed)
@@ -19,14 +45,17 @@ class BootstrapFromEach(object):
         self.randS = RandomStrategy(seed)
         
     def bootstrap(self, pool, y, k=1):
-        data = defaultdict(lambda: [])
-        for i in pool:
-            data[y[i]].append(i)
+        if isinstance(pool, IndexPool):
+            members = np.sort(pool.indices())
+        else:
+            members = np.array(sorted(pool), dtype=np.intp)
+        members_y = y[members]
+        labels = np.unique(members_y)
         chosen = []
-        num_classes = len(data.keys())
+        num_classes = len(labels)
         # print k/num_classes, k, num_classes
-        for label in data.keys():
-            candidates = data[label]
+        for label in labels:
+            candidates = members[members_y == label].tolist()
             indices = self.randS.chooseNext(candidates, k=k/num_classes)
             chosen.extend(indices)
         return chosen
@@ -41,64 +70,154 @@ class BaseStrategy(object):
     def chooseNext(self, pool, X=None, model=None, k=1, current_train_indices = None, current_train_y = None):
         pass
 
+    # State kept between calls of chooseNext, saved by checkpoints (the random generator is saved apart)
+    def checkpointState(self):
+        return {}
+
+    def restoreState(self, state):
+        pass
+
+    # TrainingBuffer of X holding the current training set, kept between calls of chooseNext
+    def trainingBuffer(self, X, current_train_indices, current_train_y):
+        buffer = getattr(self, 'buffer', None)
+        if buffer is None or buffer.source is not X:
+            buffer = TrainingBuffer(X)
+            self.buffer = buffer
+        buffer.sync(current_train_indices, current_train_y)
+        return buffer
+
+    # Lookahead mode of the strategy name (see STRATEGY_LOOKAHEADS), with the WarmStarter of its 'warm'
+    # fits, started from the current model, and the number of best candidates of the influence
+    # lookahead rescored by refits
+    def setLookahead(self, name, lookahead, warm=None, exact_top=0):
+        self.lookahead = checkLookahead(lookahead, self.classifier, STRATEGY_LOOKAHEADS[name])
+        self.warm = warm
+        if warm is None:
+            self.warm = WarmStarter()
+        self.exact_top = exact_top
+
+    # Engine of the lookahead mode on the current training set, None if the mode refits or the
+    # engine cannot take the labels of the candidates
+    def makeEngine(self, X_train, train_y, labels):
+        if not self.lookahead in ENGINES:
+            return None
+        engine = lookaheadEngine(self.lookahead, self.classifier, self.classifier_args, X_train, train_y)
+        if not engine.supports(labels):
+            # the current training set misses a class, refit instead
+            return None
+        return engine
+
+    # Replaces the influence utilities of the exact_top best candidates (largest or smallest utils) by score(i)
+    def refitBest(self, utils, score, largest=True, executor=None):
+        if self.lookahead != 'influence' or not self.exact_top:
+            return utils
+        order = np.argsort(utils)
+        if largest:
+            order = order[::-1]
+        best = order[:self.exact_top]
+        if executor is None:
+            executor = SerialExecutor()
+        for i, util in zip(best, executor.map(score, best)):
+            utils[i] = util
+        return utils
+
+    # Model of a hypothetical training set: refit, or warm-started from the current model
+    def fit(self, X, y, model=None, X_eval=None):
+        if self.lookahead == 'warm':
+            return self.warm.fit(self.classifier, self.classifier_args, model, X, y, X_eval)
+        new_classifier = self.classifier(**self.classifier_args)
+        new_classifier.fit(X, y)
+        return new_classifier
+
 class RandomStrategy(BaseStrategy):
         
     def chooseNext(self, pool, X=None, model=None, k=1, current_train_indices = None, current_train_y = None):
-        list_pool = list(pool)
-        rand_indices = self.randgen.permutation(len(pool))
-        return [list_pool[i] for i in rand_indices[:k]]
+        return sampleCandidates(pool, k, self.randgen)
 
 class UncStrategy(BaseStrategy):
     
-    def __init__(self, seed=0, sub_pool = None):
+    def __init__(self, seed=0, sub_pool = None, measure = 'minprob', full_pool = False, chunk_size = 1000):
         super(UncStrategy, self).__init__(seed=seed)
         self.sub_pool = sub_pool
+        # minprob, margin or entropy (see utilities.uncertainty)
+        if not measure in ['minprob', 'margin', 'entropy']:
+            raise ValueError("Unknown uncertainty: %s" % measure)
+        self.measure = measure
+        # Score the whole pool, chunk_size rows at a time, instead of a random sub pool
+        self.full_pool = full_pool
+        self.chunk_size = chunk_size
     
     def chooseNext(self, pool, X=None, model=None, k=1, current_train_indices = None, current_train_y = None):
         
+        if ss.issparse(X):
+            if not ss.isspmatrix_csr(X):
+                X = X.tocsr()
+        
+        if self.full_pool:
+            return self.chooseFromPool(pool, X, model, k)
+        
         num_candidates = len(pool)
         
         if self.sub_pool is not None:
             num_candidates = self.sub_pool
         
-        rand_indices = self.randgen.permutation(len(pool))        
-        list_pool = list(pool)        
-        candidates = [list_pool[i] for i in rand_indices[:num_candidates]]
-        
-        if ss.issparse(X):
-            if not ss.isspmatrix_csr(X):
-                X = X.tocsr()
+        candidates = sampleCandidates(pool, num_candidates, self.randgen)
         
-        probs = model.predict_proba(X[candidates])        
-        uncerts = np.min(probs, axis=1)        
+        with timers.phase('predict_proba'):
+            probs = model.predict_proba(X[candidates])
+        uncerts = uncertainty(probs, self.measure)
         uis = np.argsort(uncerts)[::-1]
         chosen = [candidates[i] for i in uis[:k]]       
         return chosen
 
+    """
+    Exact selection over the whole pool: the members are scored chunk_size rows at a time and
+    only the k most uncertain seen so far are kept (argpartition over them plus the new chunk),
+    so memory stays bounded by the chunk whatever the size of the pool.
+    """
+    def chooseFromPool(self, pool, X, model, k):
+        if isinstance(pool, IndexPool):
+            members = np.sort(pool.indices())
+        else:
+            members = np.array(sorted(pool), dtype=np.intp)
+
+        top = np.array([], dtype=np.intp)
+        top_uncerts = np.array([])
+
+        for start in range(0, len(members), self.chunk_size):
+            chunk = members[start:start + self.chunk_size]
+            with timers.phase('predict_proba'):
+                probs = model.predict_proba(X[chunk])
+
+            indices = np.concatenate([top, chunk])
+            uncerts = np.concatenate([top_uncerts, uncertainty(probs, self.measure)])
+            if len(indices) > k:
+                keep = np.argpartition(-uncerts, k - 1)[:k]
+                indices = indices[keep]
+                uncerts = uncerts[keep]
+            top = indices
+            top_uncerts = uncerts
+
+        uis = np.argsort(-top_uncerts, kind='mergesort')
+        return top[uis].tolist()
+
 class QBCStrategy(BaseStrategy):
     
-    def __init__(self, classifier, classifier_args, seed=0, sub_pool = None, num_committee = 4):
+    def __init__(self, classifier, classifier_args, seed=0, sub_pool = None, num_committee = 4, disagreement = 'vote'):
         super(QBCStrategy, self).__init__(seed=seed)
         self.sub_pool = sub_pool
         self.num_committee = num_committee
         self.classifier = classifier
         self.classifier_args = classifier_args
+        # 'vote' is the vote entropy of the hard predictions, 'kl' the mean KL divergence of the soft votes
+        if not disagreement in ['vote', 'kl']:
+            raise ValueError("Unknown disagreement: %s" % disagreement)
+        self.disagreement = disagreement
         
     
     def vote_entropy(self, sample):
         """ Computes vote entropy. """
-        votes = defaultdict(lambda: 0.0)
-        size = float(len(sample))
-
-        for i in sample:
-            votes[i] += 1.0
-
-        out = 0
-        for i in votes:
-            aux = (float(votes[i]/size))
-            out += ((aux*math.log(aux, 2))*-1.)
-
-        return out
+        return vote_entropy(np.asarray(sample)[:, np.newaxis])[0]
     
     def chooseNext(self, pool, X=None, model=None, k=1, current_train_indices = None, current_train_y = None):
          
@@ -108,9 +227,7 @@ class QBCStrategy(BaseStrategy):
         if self.sub_pool is not None:
             num_candidates = self.sub_pool
         
-        rand_indices = self.randgen.permutation(len(pool))        
-        list_pool = list(pool)        
-        candidates = [list_pool[i] for i in rand_indices[:num_candidates]]
+        candidates = sampleCandidates(pool, num_candidates, self.randgen)
         
         if ss.issparse(X):
             if not ss.isspmatrix_csr(X):
@@ -118,28 +235,37 @@ class QBCStrategy(BaseStrategy):
         
         # Create bags
         
-        comm_predictions = []
+        X_candidates = X[candidates]
+        classes = np.unique(current_train_y)
+        
+        # (committee x candidates) hard votes, or (committee x candidates x classes) soft votes
+        if self.disagreement == 'vote':
+            comm_predictions = np.empty((self.num_committee, len(candidates)), dtype=np.asarray(current_train_y).dtype)
+        else:
+            comm_predictions = np.zeros((self.num_committee, len(candidates), len(classes)))
         
         for c in range(self.num_committee):
             r_inds = self.randgen.randint(0, len(current_train_indices), size=len(current_train_indices))
             bag = [current_train_indices[i] for i in r_inds]
             bag_y = [current_train_y[i] for i in r_inds]
             new_classifier = self.classifier(**self.classifier_args)
-            new_classifier.fit(X[bag], bag_y)
-            
-            predictions = new_classifier.predict(X[candidates])
+            with timers.phase('committee.fit'):
+                new_classifier.fit(X[bag], bag_y)
             
-            comm_predictions.append(predictions)
+            with timers.phase('committee.predict'):
+                if self.disagreement == 'vote':
+                    comm_predictions[c] = new_classifier.predict(X_candidates)
+                else:
+                    # a bag may miss a class, align its columns with the classes of the training set
+                    columns = np.searchsorted(classes, new_classifier.classes_)
+                    comm_predictions[c][:, columns] = new_classifier.predict_proba(X_candidates)
         
         # Compute disagreement for com_predictions
-
-        disagreements = []
-        for i in range(len(comm_predictions[0])):
-            aux_candidates = []
-            for prediction in comm_predictions:
-                aux_candidates.append(prediction[i])
-            disagreement = self.vote_entropy(aux_candidates)
-            disagreements.append(disagreement)
+        with timers.phase('utility'):
+            if self.disagreement == 'vote':
+                disagreements = vote_entropy(comm_predictions)
+            else:
+                disagreements = kl_disagreement(comm_predictions)
         
         dis = np.argsort(disagreements)[::-1]
         chosen = [candidates[i] for i in dis[:k]]
@@ -148,17 +274,15 @@ class QBCStrategy(BaseStrategy):
 
 class LogGainStrategy(BaseStrategy):
     
-    def __init__(self, classifier, classifier_args, seed = 0, sub_pool = None):
+    def __init__(self, classifier, classifier_args, seed = 0, sub_pool = None, lookahead = 'refit', warm = None, exact_top = 0):
         super(LogGainStrategy, self).__init__(seed=seed)
         self.classifier = classifier
         self.sub_pool = sub_pool
         self.classifier_args = classifier_args
+        self.setLookahead('loggain', lookahead, warm, exact_top)
     
     def log_gain(self, probs, labels):
-        lg = 0
-        for i in xrange(len(probs)):
-            lg -= np.log(probs[i][int(labels[i])])
-        return lg
+        return -log_gain(probs, labels)
     
     def chooseNext(self, pool, X=None, model=None, k=1, current_train_indices = None, current_train_y = None):
         
@@ -167,35 +291,45 @@ class LogGainStrategy(BaseStrategy):
         if self.sub_pool is not None:
             num_candidates = self.sub_pool
         
-        list_pool = list(pool)
-        
-        
         #random candidates
-        rand_indices = self.randgen.permutation(len(pool))                
-        candidates = [list_pool[i] for i in rand_indices[:num_candidates]]
+        candidates = sampleCandidates(pool, num_candidates, self.randgen)
         
         if ss.issparse(X):
             if not ss.isspmatrix_csr(X):
                 X = X.tocsr()
                         
-        cand_probs = model.predict_proba(X[candidates])    
+        with timers.phase('predict_proba'):
+            cand_probs = model.predict_proba(X[candidates])
         
-        utils = []
+        buffer = self.trainingBuffer(X, current_train_indices, current_train_y)
+        X_train = buffer.view()[0]
+
+        engine = self.makeEngine(X_train, current_train_y, [0, 1])
         
-        for i in xrange(num_candidates):
+        def score(i):
             #assume binary
-            new_train_inds = list(current_train_indices)
-            new_train_inds.append(candidates[i])
             util = 0
             for c in [0, 1]:
-                new_train_y = list(current_train_y)
-                new_train_y.append(c)
-                new_classifier = self.classifier(**self.classifier_args)
-                new_classifier.fit(X[new_train_inds], new_train_y)
-                new_probs = new_classifier.predict_proba(X[current_train_indices])
-                util += cand_probs[i][c] * self.log_gain(new_probs, current_train_y)
+                new_X, new_train_y = buffer.extended(candidates[i], c)
+                with timers.phase('lookahead.fit'):
+                    new_classifier = self.fit(new_X, new_train_y, model, X_train)
+                with timers.phase('lookahead.predict_proba'):
+                    new_probs = new_classifier.predict_proba(X_train)
+                with timers.phase('lookahead.utility'):
+                    util += cand_probs[i][c] * self.log_gain(new_probs, current_train_y)
+            return util
+        
+        if engine is not None:
+            utils = np.zeros(len(candidates))
+            for c in [0, 1]:
+                for start, new_probs in engine.iterPredictProba(X_train, [(X[candidates], [c] * len(candidates), 1)]):
+                    with timers.phase('lookahead.utility'):
+                        for j in xrange(len(new_probs)):
+                            utils[start + j] += cand_probs[start + j][c] * self.log_gain(new_probs[j], current_train_y)
             
-            utils.append(util)
+            utils = self.refitBest(utils, score, largest=False)
+        else:
+            utils = [score(i) for i in xrange(len(candidates))]
         
         uis = np.argsort(utils)
         
@@ -206,20 +340,15 @@ class LogGainStrategy(BaseStrategy):
 
 class ErrorReductionStrategy(BaseStrategy):
     
-    def __init__(self, classifier, classifier_args, seed = 0, sub_pool = None):
+    def __init__(self, classifier, classifier_args, seed = 0, sub_pool = None, lookahead = 'refit', warm = None, exact_top = 0):
         super(ErrorReductionStrategy, self).__init__(seed=seed)
         self.classifier = classifier
         self.sub_pool = sub_pool
         self.classifier_args = classifier_args
+        self.setLookahead('erreduct', lookahead, warm, exact_top)
     
     def log_loss(self, probs):
-        ll = 0
-
-        for i in xrange(len(probs)):
-            for prob in probs[i]:
-                ll -= (prob*np.log(prob))
-
-        return ll/(len(probs)*1.)
+        return expected_log_loss(probs)
     
     def chooseNext(self, pool, X=None, model=None, k=1, current_train_indices = None, current_train_y = None):
         
@@ -228,35 +357,46 @@ class ErrorReductionStrategy(BaseStrategy):
         if self.sub_pool is not None:
             num_candidates = self.sub_pool
         
-        list_pool = list(pool) #X[list_pool] = Unlabeled data = U = p
-        
-        
         #random candidates
-        rand_indices = self.randgen.permutation(len(pool))                
-        candidates = [list_pool[i] for i in rand_indices[:num_candidates]]
+        candidates = sampleCandidates(pool, num_candidates, self.randgen) #X[candidates] = Unlabeled data = U = p
         
         if ss.issparse(X):
             if not ss.isspmatrix_csr(X):
                 X = X.tocsr()
+        
+        X_candidates = X[candidates]
                         
-        cand_probs = model.predict_proba(X[candidates])    
+        with timers.phase('predict_proba'):
+            cand_probs = model.predict_proba(X_candidates)
         
-        utils = []
+        buffer = self.trainingBuffer(X, current_train_indices, current_train_y)
+
+        engine = self.makeEngine(buffer.view()[0], current_train_y, [0, 1])
         
-        for i in xrange(num_candidates):
+        def score(i):
             #assume binary
-            new_train_inds = list(current_train_indices)
-            new_train_inds.append(candidates[i])
             util = 0
             for c in [0, 1]:
-                new_train_y = list(current_train_y)
-                new_train_y.append(c)
-                new_classifier = self.classifier(**self.classifier_args)
-                new_classifier.fit(X[new_train_inds], new_train_y)
-                new_probs = new_classifier.predict_proba(X[candidates]) #X[current_train_indices] = labeled = L
-                util += cand_probs[i][c] * self.log_loss(new_probs)
+                new_X, new_train_y = buffer.extended(candidates[i], c)
+                with timers.phase('lookahead.fit'):
+                    new_classifier = self.fit(new_X, new_train_y, model, X_candidates)
+                with timers.phase('lookahead.predict_proba'):
+                    new_probs = new_classifier.predict_proba(X_candidates) #X[current_train_indices] = labeled = L
+                with timers.phase('lookahead.utility'):
+                    util += cand_probs[i][c] * self.log_loss(new_probs)
+            return util
+        
+        if engine is not None:
+            utils = np.zeros(len(candidates))
+            for c in [0, 1]:
+                for start, new_probs in engine.iterPredictProba(X_candidates, [(X_candidates, [c] * len(candidates), 1)]):
+                    with timers.phase('lookahead.utility'):
+                        for j in xrange(len(new_probs)):
+                            utils[start + j] += cand_probs[start + j][c] * self.log_loss(new_probs[j])
             
-            utils.append(util)
+            utils = self.refitBest(utils, score, largest=False)
+        else:
+            utils = [score(i) for i in xrange(len(candidates))]
         
         uis = np.argsort(utils)
         
@@ -273,14 +413,64 @@ class RotateStrategy(BaseStrategy):
         self.strategies = strategies
         self.counter = -1
     
+    def checkpointState(self):
+        return {'counter': self.counter, 'strategies': [s.checkpointState() for s in self.strategies]}
+
+    def restoreState(self, state):
+        self.counter = state['counter']
+        for s, s_state in zip(self.strategies, state['strategies']):
+            s.restoreState(s_state)
+
     def chooseNext(self, pool, X=None, model=None, k=1, current_train_indices = None, current_train_y = None):
         self.counter = (self.counter+1) % len(self.strategies)
         return self.strategies[self.counter].chooseNext(pool, X, model, k=k, current_train_indices = current_train_indices, current_train_y = current_train_y)
                 
 
+"""
+Fits a new classifier on a hypothetical training set and scores it on the test set.
+Sets with a single class get -inf. With base_model, the fit is warm-started from it by warm (a WarmStarter).
+"""
+def lookaheadUtility(classifier, classifier_args, X_train, y_train, X_test, y_test, option='log', base_model=None, warm=None):
+    util = -np.inf
+
+    if len(set(y_train)) > 1:
+        with timers.phase('lookahead.fit'):
+            if base_model is not None:
+                # warm start from the solution of the current model
+                if warm is None:
+                    warm = WarmStarter()
+                new_classifier = warm.fit(classifier, classifier_args, base_model, X_train, y_train, X_test)
+            else:
+                new_classifier = classifier(**classifier_args)
+                new_classifier.fit(X_train, y_train)
+
+        with timers.phase('lookahead.predict_proba'):
+            if (classifier) == type(GaussianNB()):
+                new_probs = new_classifier.predict_proba(X_test.toarray())
+            else:
+                new_probs = new_classifier.predict_proba(X_test)
+
+        with timers.phase('lookahead.utility'):
+            util = utility(new_probs, y_test, option, new_classifier.classes_)
+
+    return util
+
+"""
+lookaheadUtility of the training set train_indices of X, memoized in cache (a UtilityCache) if given.
+training, if given, returns the training matrix in place of X[train_indices] (e.g. from a TrainingBuffer).
+"""
+def cachedUtility(cache, classifier, classifier_args, X, train_indices, y_train, X_test, y_test, option='log', training=None):
+    if training is None:
+        training = lambda: X[train_indices]
+    compute = lambda: lookaheadUtility(classifier, classifier_args, training(), y_train, X_test, y_test, option)
+    if cache is None:
+        return compute()
+    return cache.get(cache.key(train_indices, y_train, classifier, classifier_args, option), compute)
+
 class Strategy1(BaseStrategy):
     
-    def __init__(self, classifier, classifier_args, seed = 0, sub_pool = None, X_test = None, y_test = None, y_pool = None, option = 'log'):
+    def __init__(self, classifier, classifier_args, seed = 0, sub_pool = None, X_test = None, y_test = None, y_pool = None, option = 'log', executor = None, lookahead = 'refit', cache = None,
+                 racing = False, race_start = 256, race_confidence = 0.95, warm = None, exact_top = 0, greedy_batch = False):
         super(Strategy1, self).__init__(seed=seed)
         self.classifier = classifier
         self.sub_pool = sub_pool
@@ -293,13 +483,25 @@ class Strategy1(BaseStrategy):
             self.option = 'accu'
         elif option == 'auc':
             self.option = 'auc'
+        # Scores the candidates of a lookahead step, serially unless told otherwise
+        self.executor = executor
+        if executor is None:
+            self.executor = SerialExecutor()
+        self.setLookahead('s1', lookahead, warm, exact_top)
+        # UtilityCache of the refit utilities
+        self.cache = cache
+        # Racing of the refit candidates over growing subsets of the test set, in a fixed random order
+        self.racing = racing
+        self.race_start = race_start
+        self.race_confidence = race_confidence
+        if racing:
+            self.test_order = np.random.RandomState(seed).permutation(len(y_test))
+        # Batches of k > 1 chosen one instance at a time (see greedyBatch) instead of the top k
+        self.greedy_batch = greedy_batch
 
     
     def log_gain(self, probs, labels):
-        lg = 0
-        for i in xrange(len(probs)):
-            lg += np.log(probs[i][int(labels[i])])
-        return lg
+        return log_gain(probs, labels)
 
 
     def chooseNext(self, pool, X=None, model=None, k=1, current_train_indices = None, current_train_y = None):
@@ -312,62 +514,52 @@ class Strategy1(BaseStrategy):
         if self.sub_pool is not None and len(pool) > self.sub_pool:
             num_candidates = self.sub_pool
         
-        list_pool = list(pool)
-        
-        
         #random candidates
-        rand_indices = self.randgen.permutation(len(pool))                
-        candidates = [list_pool[i] for i in rand_indices[:num_candidates]]
+        candidates = sampleCandidates(pool, num_candidates, self.randgen)
         
         if ss.issparse(X):
             if not ss.isspmatrix_csr(X):
                 X = X.tocsr()
                         
-        utils = []
-        
-        for i in xrange(num_candidates):
-            
-            new_train_inds = list(current_train_indices)
+        # the threads of a ThreadExecutor would write their candidates over each other in a TrainingBuffer
+        buffered = not isinstance(self.executor, ThreadExecutor)
+        if buffered:
+            # synced before the workers of a ProcessExecutor fork
+            self.trainingBuffer(X, current_train_indices, current_train_y)
+
+        def score(i, train_indices=current_train_indices, train_y=current_train_y):
+            new_train_inds = list(train_indices)
             new_train_inds.append(candidates[i])
             
             
-            new_train_y = list(current_train_y)
+            new_train_y = list(train_y)
             new_train_y.append(self.y_pool[candidates[i]]) # check this # CHEATING 1
 
-            util = -np.inf
+            training = lambda: X[new_train_inds]
+            if buffered:
+                buffer = self.trainingBuffer(X, train_indices, train_y)
+                training = lambda: buffer.extended(candidates[i], new_train_y[-1])[0]
 
-            if len(set(new_train_y)) > 1:
-                new_classifier = self.classifier(**self.classifier_args)
-                new_classifier.fit(X[new_train_inds], new_train_y)
+            if self.lookahead == 'warm':
+                return lookaheadUtility(self.classifier, self.classifier_args, training(), new_train_y, self.X_test, self.y_test, self.option, model, self.warm)
+            return cachedUtility(self.cache, self.classifier, self.classifier_args, X, new_train_inds, new_train_y, self.X_test, self.y_test, self.option, training)
+        
+        labels = self.y_pool[candidates]
+        engine = self.makeEngine(X[current_train_indices], current_train_y, labels)
 
-                if (self.classifier) == type(GaussianNB()):
-                    new_probs = new_classifier.predict_proba(self.X_test.toarray())
-                else:
-                    new_probs = new_classifier.predict_proba(self.X_test)
-
-                # compute utility # CHEATING 2
-                if self.option == 'log':
-                    #LOGGAIN on test
-                    # new_probs = new_classifier.predict_proba(self.X_test)
-                    util = self.log_gain(new_probs, self.y_test)
-
-                elif self.option == 'auc':
-                # OR AUC on the test
-                    auc = metrics.roc_auc_score(self.y_test, new_probs[:,1])
-                    util = auc
-                    # print len(new_probs[:,1])
-                    # print util
-
-                elif self.option == 'accu':
-                # OR accuracy on the test
-                    pred_y = model.classes_[np.argmax(new_probs, axis=1)]
-                    
-                    accu = metrics.accuracy_score(self.y_test, pred_y)
-                    util = accu
-            
-            utils.append(util)
+        if engine is not None:
+            utils = self.engineUtilities(engine, X[candidates], labels, current_train_y)
+            utils = self.refitBest(utils, score, executor=self.executor)
+        elif self.racing:
+            # the gains of greedyBatch are over utilities of the whole test set, not the rows the race saw
+            utils = self.race(X, candidates, current_train_indices, current_train_y, k, model, complete=self.greedy_batch and k > 1)
+        else:
+            utils = self.executor.map(score, range(len(candidates)))
         # print
 
+        if self.greedy_batch and k > 1:
+            return self.greedyBatch(X, candidates, current_train_indices, current_train_y, k, utils, score, engine is not None)
+
         # print utils
         uis = np.argsort(utils)
         uis = uis[::-1]
@@ -382,9 +574,167 @@ class Strategy1(BaseStrategy):
 
         return chosen
 
+    """
+    Utilities of the models of engine updated with each row of X_rows and its label.
+    """
+    def engineUtilities(self, engine, X_rows, labels, train_y):
+        utils = []
+        for start, new_probs in engine.iterPredictProba(self.X_test, [(X_rows, labels, 1)]):
+            with timers.phase('lookahead.utility'):
+                for j in xrange(len(new_probs)):
+                    util = -np.inf
+                    if len(set(train_y) | set([labels[start + j]])) > 1:
+                        util = utility(new_probs[j], self.y_test, self.option, engine.classes)
+                    utils.append(util)
+        return utils
+
+    """
+    Lazy greedy batch: the k instances are added one at a time, each the candidate of largest
+    gain in utility over the training set extended with the ones already chosen. Gains only
+    shrink as the set grows for (near) submodular utilities, so the gains scored against an
+    earlier set are upper bounds: the candidates wait in a heap by their last gain, and only the
+    one on top is scored again, until it stays on top against the current set. utils are the
+    single-instance utilities of the candidates, score(i, train_indices, train_y) refits them and
+    with incremental, the lookahead engine of the extended set scores them instead.
+    """
+    def greedyBatch(self, X, candidates, current_train_indices, current_train_y, k, utils, score, incremental=False):
+        train_indices = list(current_train_indices)
+        train_y = list(current_train_y)
+
+        base = cachedUtility(self.cache, self.classifier, self.classifier_args, X, train_indices, train_y, self.X_test, self.y_test, self.option)
+
+        def gain(util):
+            # a training set of a single class has no utility to improve on
+            if np.isfinite(base):
+                return util - base
+            return util
+
+        # (-gain, candidate, round it was scored in, utility)
+        heap = [(-gain(utils[i]), i, 0, utils[i]) for i in range(len(candidates))]
+        heapq.heapify(heap)
+
+        chosen = []
+        engine = None
+        while heap and len(chosen) < k:
+            bound, i, scored, util = heapq.heappop(heap)
+            if scored == len(chosen):
+                chosen.append(candidates[i])
+                train_indices.append(candidates[i])
+                train_y.append(self.y_pool[candidates[i]])
+                base = util
+                engine = None
+                continue
+
+            label = self.y_pool[candidates[i]]
+            if incremental:
+                if engine is None:
+                    engine = lookaheadEngine(self.lookahead, self.classifier, self.classifier_args, X[train_indices], train_y)
+                if engine.supports([label]):
+                    util = self.engineUtilities(engine, X[[candidates[i]]], [label], train_y)[0]
+                else:
+                    util = score(i, train_indices, train_y)
+            else:
+                util = score(i, train_indices, train_y)
+            heapq.heappush(heap, (-gain(util), i, len(chosen), util))
+
+        return chosen
+
+    """
+    Racing of the candidates: their models are fit once and scored on the first race_start rows
+    of the (shuffled) test set, then on twice as many rows each round. After each round, for log
+    gain and accuracy (means of per-row scores) the candidates confidently worse than the k-th best
+    are dropped, by a confidence interval on their per-row differences to it (the candidates only
+    differ by one instance, so paired differences separate them far sooner than their own means);
+    AUC is not a per-row mean, so the better half is kept instead (successive halving). The race
+    stops once k candidates are left or the whole test set is used. Returns the utilities of the
+    survivors on the rows they were scored on, -inf for the others; with complete, the survivors
+    are first scored on the rest of the test set.
+    """
+    def race(self, X, candidates, current_train_indices, current_train_y, k, model=None, complete=False):
+
+        def fit(i):
+            new_train_inds = list(current_train_indices)
+            new_train_inds.append(candidates[i])
+            new_train_y = list(current_train_y)
+            new_train_y.append(self.y_pool[candidates[i]])
+            if len(set(new_train_y)) < 2:
+                return None
+
+            with timers.phase('lookahead.fit'):
+                return self.fit(X[new_train_inds], new_train_y, model)
+
+        models = self.executor.map(fit, range(len(candidates)))
+        alive = [i for i in range(len(candidates)) if models[i] is not None]
+
+        # per-row log gains or hits, or the positive-class probabilities for auc
+        scores = [[] for i in range(len(candidates))]
+        z = norm.ppf(0.5 + self.race_confidence / 2.)
+
+        # scores the alive candidates on the test rows start to stop
+        def scoreRows(start, stop):
+            X_rows = self.X_test[self.test_order[start:stop]]
+            y_rows = np.asarray(self.y_test)[self.test_order[start:stop]]
+            if (self.classifier) == type(GaussianNB()):
+                X_rows = X_rows.toarray()
+
+            def predict(i):
+                with timers.phase('lookahead.predict_proba'):
+                    return models[i].predict_proba(X_rows)
+
+            new_probs = self.executor.map(predict, alive)
+
+            with timers.phase('lookahead.utility'):
+                for i, probs in zip(alive, new_probs):
+                    if self.option == 'auc':
+                        scores[i].append(probs[:, 1])
+                    elif self.option == 'log':
+                        scores[i].append(np.log(np.maximum(probs[np.arange(len(y_rows)), y_rows.astype(int)], TINY)))
+                    else:
+                        scores[i].append((models[i].classes_[np.argmax(probs, axis=1)] == y_rows) * 1.)
+
+        seen = 0
+        size = min(self.race_start, len(self.test_order))
+        while alive:
+            scoreRows(seen, size)
+            seen = size
+
+            with timers.phase('lookahead.utility'):
+                if len(alive) <= k or seen >= len(self.test_order):
+                    break
+
+                if self.option == 'auc':
+                    y_seen = np.asarray(self.y_test)[self.test_order[:seen]]
+                    if len(set(y_seen)) > 1:
+                        aucs = np.array([metrics.roc_auc_score(y_seen, np.concatenate(scores[i])) for i in alive])
+                        keep = np.argsort(aucs)[::-1][:max(k, (len(alive) + 1) / 2)]
+                        alive = [alive[j] for j in sorted(keep)]
+                else:
+                    rows = np.array([np.concatenate(scores[i]) for i in alive])
+                    reference = np.argsort(np.mean(rows, axis=1))[::-1][k - 1]
+                    differences = rows - rows[reference]
+                    upper = np.mean(differences, axis=1) + z * np.std(differences, axis=1) / np.sqrt(seen)
+                    alive = [alive[j] for j in range(len(alive)) if upper[j] >= 0]
+
+            size = min(2 * size, len(self.test_order))
+
+        if complete and alive and seen < len(self.test_order):
+            scoreRows(seen, len(self.test_order))
+            seen = len(self.test_order)
+
+        utils = np.repeat(-np.inf, len(candidates))
+        y_seen = np.asarray(self.y_test)[self.test_order[:seen]]
+        for i in alive:
+            if self.option == 'auc':
+                utils[i] = metrics.roc_auc_score(y_seen, np.concatenate(scores[i])) if len(set(y_seen)) > 1 else 0.5
+            elif self.option == 'log':
+                utils[i] = np.sum(np.concatenate(scores[i]))
+            else:
+                utils[i] = np.mean(np.concatenate(scores[i]))
+        return utils
+
 class Strategy2(BaseStrategy):
     
-    def __init__(self, classifier, classifier_args, seed = 0, sub_pool = None, X_test = None, y_test = None, y_pool = None, option = 'log'):
+    def __init__(self, classifier, classifier_args, seed = 0, sub_pool = None, X_test = None, y_test = None, y_pool = None, option = 'log', executor = None, lookahead = 'refit', cache = None, warm = None):
         super(Strategy2, self).__init__(seed=seed)
         self.classifier = classifier
         self.sub_pool = sub_pool
@@ -397,12 +747,17 @@ class Strategy2(BaseStrategy):
             self.option = 'accu'
         elif option == 'auc':
             self.option = 'auc'
+        # Scores the candidates of a lookahead step, serially unless told otherwise
+        self.executor = executor
+        if executor is None:
+            self.executor = SerialExecutor()
+        # The "training set minus i" models: refits, NB count subtraction or warm-started refits
+        self.setLookahead('s2', lookahead, warm)
+        # UtilityCache of the refit utilities (warm-started fits depend on the current model, they are not cached)
+        self.cache = cache
     
     def log_gain(self, probs, labels):
-        lg = 0
-        for i in xrange(len(probs)):
-            lg += np.log(probs[i][int(labels[i])])
-        return lg
+        return log_gain(probs, labels)
 
 
     def chooseNext(self, pool, X=None, model=None, k=1, current_train_indices = None, current_train_y = None):
@@ -420,45 +775,37 @@ class Strategy2(BaseStrategy):
             if not ss.isspmatrix_csr(X):
                 X = X.tocsr()
                         
-        utils = []
-        
-        for i in rand_indices[:num_candidates]:
-            
-            new_train_inds = list(current_train_indices)
-            del new_train_inds[i]
-            
-            new_train_y = list(current_train_y)
-            del new_train_y[i]
-
-            util = -np.inf
-            # print set(new_train_y)
-            if len(set(new_train_y)) > 1:
-                new_classifier = self.classifier(**self.classifier_args)
-                new_classifier.fit(X[new_train_inds], new_train_y)
-
-                if (self.classifier) == type(GaussianNB()):
-                    new_probs = new_classifier.predict_proba(self.X_test.toarray())
-                else:
-                    new_probs = new_classifier.predict_proba(self.X_test)
-
-                # compute utility # CHEATING 2
-                if self.option == 'log':
-                    #LOGGAIN on test
-                    # new_probs = new_classifier.predict_proba(self.X_test)
-                    util = self.log_gain(new_probs, self.y_test)
-
-                elif self.option == 'auc':
-                # OR AUC on the test
-                    auc = metrics.roc_auc_score(self.y_test, new_probs[:,1])
-                    util = auc
-                elif self.option == 'accu':
-                # OR accuracy on the test
-                    pred_y = model.classes_[np.argmax(new_probs, axis=1)]
-                    
-                    accu = metrics.accuracy_score(self.y_test, pred_y)
-                    util = accu
+        train_indices = np.asarray(current_train_indices)
+        train_y = np.asarray(current_train_y)
+        removed = rand_indices[:num_candidates]
+
+        if self.lookahead == 'nb':
+            # Subtract each candidate's counts from the model of the whole training set
+            engine = NBLookahead(self.classifier, self.classifier_args, X[train_indices], train_y)
+            utils = []
+            for start, new_probs in engine.iterPredictProba(self.X_test, [(X[train_indices[removed]], train_y[removed], -1)]):
+                with timers.phase('lookahead.utility'):
+                    for j in xrange(len(new_probs)):
+                        util = -np.inf
+                        if engine.numClasses(removed=[train_y[removed[start + j]]]) > 1:
+                            util = utility(new_probs[j], self.y_test, self.option, engine.classes)
+                        utils.append(util)
+        else:
+            base_model = None
+            if self.lookahead == 'warm' and len(set(current_train_y)) > 1:
+                base_model = self.classifier(**self.classifier_args)
+                with timers.phase('lookahead.fit'):
+                    base_model.fit(X[train_indices], train_y)
+
+            def score(i):
+                new_train_inds = np.delete(train_indices, i)
+                new_train_y = np.delete(train_y, i)
+
+                if base_model is not None:
+                    return lookaheadUtility(self.classifier, self.classifier_args, X[new_train_inds], new_train_y, self.X_test, self.y_test, self.option, base_model, self.warm)
+                return cachedUtility(self.cache, self.classifier, self.classifier_args, X, new_train_inds, new_train_y, self.X_test, self.y_test, self.option)
             
-            utils.append(util)
+            utils = self.executor.map(score, removed)
         # print
         uis = np.argsort(utils)
         uis = uis[::-1]
@@ -471,89 +818,81 @@ class Strategy2(BaseStrategy):
 """
 It takes the result of one strategy and tries to improve it, by replacing elements from the output by other in pool.
 Uses accuracy, AUC or log gain to compare results
+Each round proposes batch_size random swaps, scores them through executor and keeps the best one if it improves
+the utility; number_trials swaps are tried overall. With incremental, NB classifiers score the swaps from the
+counts of the current training set (NBLookahead) instead of refitting. The refit utilities are memoized in cache (a UtilityCache) if given.
 """
-def makeItBetter(X, y, X_test, y_test, current_train_indices, pool, number_trials, classifier, alpha, option='auc', seed=42):
+def makeItBetter(X, y, X_test, y_test, current_train_indices, pool, number_trials, classifier, alpha, option='auc', seed=42, batch_size=1, executor=None, incremental=False, cache=None):
     
     randgen = np.random
     randgen.seed(seed)
-    comp = len(current_train_indices)
-    comp2 = len(pool)
 
-    new_classifier = classifier(**alpha)
+    if executor is None:
+        executor = SerialExecutor()
 
-    # Calculating accuracy, AUC or log gain of the giving current_train_indices
-    previous_util = -np.inf
-
-    if len(set(y[current_train_indices])) > 1:
-        new_classifier.fit(X[current_train_indices], y[current_train_indices])
-
-        if (classifier) == type(GaussianNB()):
-                new_probs = new_classifier.predict_proba(X_test.toarray())
-        else:
-            new_probs = new_classifier.predict_proba(X_test)
+    current_train_indices = list(current_train_indices)
+    if isinstance(pool, IndexPool):
+        pool = IndexPool(len(y), pool.indices())
+    else:
+        pool = IndexPool(len(y), pool)
 
-        if option == 'log':
-            previous_util = Strategy2.log_gain(new_probs, y_test)
+    # Calculating accuracy, AUC or log gain of the giving current_train_indices
+    previous_util = cachedUtility(cache, classifier, alpha, X, current_train_indices, y[current_train_indices], X_test, y_test, option)
 
-        elif option == 'auc':
-            auc = metrics.roc_auc_score(y_test, new_probs[:,1])
-            previous_util = auc
-        elif option == 'accu':
-            pred_y = model.classes_[np.argmax(new_probs, axis=1)]
-                    
-            accu = metrics.accuracy_score(y_test, pred_y)
-            previous_util = accu
+    engine = None
+    if incremental:
+        engine = NBLookahead(classifier, alpha, X[current_train_indices], y[current_train_indices])
 
     # Randomly replace values from training set by random elements from pool
     # Process is repeated number_trials times
-    for i in range(number_trials):
-
-        rand_indices = randgen.permutation(len(current_train_indices))
-        rand_pool = randgen.permutation(len(pool))
-
-        new_train_inds = list(current_train_indices)
-        new_pool = list(pool)
-
-        # Replacing values
-        elem = new_pool[rand_pool[0]]
-        del new_pool[rand_pool[0]]
-
-        new_pool.append(new_train_inds[rand_indices[0]])
-        del new_train_inds[rand_indices[0]]
-        new_train_inds.append(elem)
-        new_pool = set(new_pool)
-
-        util = -np.inf
-        
-        # Computing metric
-        if len(set(y[new_train_inds])) > 1:
-            new_classifier = classifier(**alpha)
-            new_classifier.fit(X[new_train_inds], y[new_train_inds])
+    for start in range(0, number_trials, batch_size):
+
+        positions = randgen.randint(0, len(current_train_indices), size=min(batch_size, number_trials - start))
+        elems = pool.sample(len(positions), randgen)
+        positions = positions[:len(elems)]
+
+        if len(elems) == 0:
+            break
+
+        removed = [current_train_indices[i] for i in positions]
+
+        if engine is not None and engine.supports(y[elems]):
+            # Computing metric from the counts, swaps leaving a single class get -inf
+            utils = []
+            for begin, new_probs in engine.iterPredictProba(X_test, [(X[elems], y[elems], 1), (X[removed], y[removed], -1)]):
+                with timers.phase('lookahead.utility'):
+                    for j in xrange(len(new_probs)):
+                        b = begin + j
+                        util = -np.inf
+                        if engine.numClasses(added=[y[elems[b]]], removed=[y[removed[b]]]) > 1:
+                            util = utility(new_probs[j], y_test, option, engine.classes)
+                        utils.append(util)
+        else:
+            def score(b):
+                new_train_inds = list(current_train_indices)
+                new_train_inds[positions[b]] = elems[b]
 
-            if (classifier) == type(GaussianNB()):
-                new_probs = new_classifier.predict_proba(X_test.toarray())
-            else:
-                new_probs = new_classifier.predict_proba(X_test)
+                # Computing metric
+                return cachedUtility(cache, classifier, alpha, X, new_train_inds, y[new_train_inds], X_test, y_test, option)
 
-            if option == 'log':
-                util = Strategy2.log_gain(new_probs, y_test)
+            utils = executor.map(score, range(len(elems)))
 
-            elif option == 'auc':
-                auc = metrics.roc_auc_score(y_test, new_probs[:,1])
-                util = auc
-            elif option == 'accu':
-                pred_y = model.classes_[np.argmax(new_probs, axis=1)]
-                    
-                accu = metrics.accuracy_score(y_test, pred_y)
-                util = accu
+        # If the best swap improves by more than rounding (the nb lookahead matches refits only to
+        # about 1e-14), keep it; otherwise undo
+        best = np.argmax(utils)
+        threshold = previous_util
+        if np.isfinite(previous_util):
+            threshold += 1e-9 * max(1, abs(previous_util))
+        if utils[best] > threshold:
+            current_train_indices[positions[best]] = elems[best]
+            pool.remove([elems[best]])
+            pool.add([removed[best]])
+            previous_util = utils[best]
 
-        # If there was improvement, keep it; otherwise undo
-        if util > previous_util:
-            current_train_indices = new_train_inds
-            pool = set(new_pool)
-            previous_util = util
+            if engine is not None:
+                engine = NBLookahead(classifier, alpha, X[current_train_indices], y[current_train_indices])
 
-    return list(current_train_indices), set(pool)
+    return list(current_train_indices), pool
 
 """
 Mix the usage of strategy1 and strategy2, randomly, based on current_temperature.
@@ -569,6 +908,14 @@ class SimulatedAnnealing(BaseStrategy):
         self.current_temperature = inicial_temperature
         self.temperature_step = temperature_step
 
+    def checkpointState(self):
+        return {'temperature': self.current_temperature, 'strategy1': self.strategy1.checkpointState(), 'strategy2': self.strategy2.checkpointState()}
+
+    def restoreState(self, state):
+        self.current_temperature = state['temperature']
+        self.strategy1.restoreState(state['strategy1'])
+        self.strategy2.restoreState(state['strategy2'])
+
     def chooseNext(self, pool=None, X=None, model=None, k=1, current_train_indices = None, current_train_y = None):
         r = self.randgen.random()
         """
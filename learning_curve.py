@@ -8,12 +8,18 @@ For now, the program is handling just binary classification
 '''
 
 import argparse
-import math
+import os
+import shutil
 import sys
+import tempfile
+import traceback
 import numpy as np
 import matplotlib.pyplot as plt
 
 from collections import defaultdict
+from multiprocessing import Pool, Process, Queue
+from multiprocessing.pool import ThreadPool
+from Queue import Empty
 from time import time
 from scipy import sparse
 
@@ -31,7 +37,16 @@ from sklearn.datasets import load_svmlight_file
 
 from sklearn.cross_validation import train_test_split
 
-from instance_strategies import LogGainStrategy, RandomStrategy, UncStrategy, RotateStrategy, BootstrapFromEach, QBCStrategy, ErrorReductionStrategy, Strategy1, Strategy2, makeItBetter, SimulatedAnnealing
+from checkpoint import TrialCheckpoint
+from datacache import loadSvmlightCached, saveCSR, loadCSR
+from executors import makeExecutor
+from lookahead import LOOKAHEADS, WarmStarter, checkLookahead, supportsWarmStart
+from pools import IndexPool
+from results import ResultsStore, ResultsWriter
+from timing import timers, summary, dump
+from trainingbuffer import TrainingBuffer
+from utilitycache import UtilityCache
+from instance_strategies import MAKEITBETTER_LOOKAHEADS, STRATEGY_LOOKAHEADS, LogGainStrategy, RandomStrategy, UncStrategy, RotateStrategy, BootstrapFromEach, QBCStrategy, ErrorReductionStrategy, Strategy1, Strategy2, makeItBetter, SimulatedAnnealing
 
 def inVector(vector, value):
 
@@ -74,152 +89,502 @@ def distribution(y):
     print 'Class 0:', class_0
     print 'Class 1:', class_1
 
-def choosingStrategies(strategy, classifier, seed, sub_pool, alpha, X_test, y_test, y_pool, s_parameter = []):
+'''
+Parses the classifier's arguments, given as "name=value,name=value" with Python values.
+'''
+def classifierArguments(arguments):
+    alpha = {}
+
+    for argument in arguments.split(','):
+        if argument.find('=') >= 0:
+            index, value = argument.split('=')
+            alpha[index] = eval(value)
+
+    return alpha
+
+'''
+Loads the pool and test sets, from the (pool, test) files of data or, if sdata is given,
+by splitting that single file. With cache_dir the files go through the binary cache.
+'''
+def loadData(data, sdata='', cache_dir=''):
+    # Two formats of data are possible, split into training and testing or not split
+    if sdata:
+        # Not Split, single file
+        if cache_dir:
+            X, y = loadSvmlightCached(sdata, cache_dir)
+        else:
+            X, y = load_svmlight_file(sdata)
+
+        # Splitting 2/3 of data as training data and 1/3 as testing
+        # Data selected randomly
+        X_pool, X_test, y_pool, y_test = train_test_split(X, y, test_size=(1./3.), random_state=42)
+
+    else:
+        # Split data
+        data_pool = data[0]
+        data_test = data[1]
+
+        if cache_dir:
+            X_pool, y_pool = loadSvmlightCached(data_pool, cache_dir)
+        else:
+            X_pool, y_pool = load_svmlight_file(data_pool)
+        num_pool, num_feat = X_pool.shape
+
+        if cache_dir:
+            X_test, y_test = loadSvmlightCached(data_test, cache_dir, n_features=num_feat)
+        else:
+            X_test, y_test = load_svmlight_file(data_test, n_features=num_feat)
+
+    return X_pool, y_pool, X_test, y_test
+
+'''
+options holds the optional settings of the strategies, filled from the command line:
+executor (candidate scoring of s1/s2 and makeItBetter), lookahead (refit, nb, warm or influence),
+disagreement (qbc), mb_batch (swaps per round of makeItBetter), checkpoint (directory)
+resume, stream (ResultsWriter), pipeline (see learningTrial), utility_cache (UtilityCache of s1, s2 and makeItBetter),
+racing, race_start and race_confidence (racing of the s1 candidates), greedy_batch (s1), unc_measure,
+unc_full_pool and unc_chunk_size (unc), shared_prefix (see prefixKind), warm_tol, warm_max_iter
+and warm_check (WarmStarter of the warm lookahead) and influence_refit (best candidates of the
+influence lookahead rescored by refits).
+'''
+def choosingStrategies(strategy, classifier, seed, sub_pool, alpha, X_test, y_test, y_pool, s_parameter = [], options = None):
+
+    if options is None:
+        options = {}
+    executor = options.get('executor')
+    lookahead = options.get('lookahead', 'refit')
+    cache = options.get('utility_cache')
+    warm = options.get('warm')
+    exact_top = options.get('influence_refit', 0)
+    disagreement = options.get('disagreement', 'vote')
 
     it = 0
 
     if strategy == 'erreduct':
-        active_s = ErrorReductionStrategy(classifier=classifier, seed=seed, sub_pool=sub_pool, classifier_args=alpha)
+        active_s = ErrorReductionStrategy(classifier=classifier, seed=seed, sub_pool=sub_pool, classifier_args=alpha, lookahead=lookahead, warm=warm, exact_top=exact_top)
     elif strategy == 'loggain':
-        active_s = LogGainStrategy(classifier=classifier, seed=seed, sub_pool=sub_pool, classifier_args=alpha)
+        active_s = LogGainStrategy(classifier=classifier, seed=seed, sub_pool=sub_pool, classifier_args=alpha, lookahead=lookahead, warm=warm, exact_top=exact_top)
     elif strategy == 'qbc':
-        active_s = QBCStrategy(classifier=classifier, classifier_args=alpha)
+        active_s = QBCStrategy(classifier=classifier, classifier_args=alpha, disagreement=disagreement)
     elif strategy == 'rand':    
         active_s = RandomStrategy(seed=seed)
     elif strategy == 'unc':
-        active_s = UncStrategy(seed=seed, sub_pool=sub_pool)
+        active_s = UncStrategy(seed=seed, sub_pool=sub_pool, measure=options.get('unc_measure', 'minprob'), full_pool=options.get('unc_full_pool', False),
+                               chunk_size=options.get('unc_chunk_size', 1000))
     elif strategy == 's1':
-        active_s = Strategy1(classifier=classifier, seed=seed, sub_pool=sub_pool, classifier_args=alpha, X_test = X_test, y_test = y_test, y_pool = y_pool, option = s_parameter)
+        active_s = Strategy1(classifier=classifier, seed=seed, sub_pool=sub_pool, classifier_args=alpha, X_test = X_test, y_test = y_test, y_pool = y_pool, option = s_parameter, executor = executor, lookahead = lookahead, cache = cache, warm = warm,
+                             racing = options.get('racing', False), race_start = options.get('race_start', 256), race_confidence = options.get('race_confidence', 0.95), exact_top = exact_top,
+                             greedy_batch = options.get('greedy_batch', False))
     elif strategy == 's2':
-        active_s = Strategy2(classifier=classifier, seed=seed, sub_pool=sub_pool, classifier_args=alpha, X_test = X_test, y_test = y_test, y_pool = y_pool, option = s_parameter)
+        active_s = Strategy2(classifier=classifier, seed=seed, sub_pool=sub_pool, classifier_args=alpha, X_test = X_test, y_test = y_test, y_pool = y_pool, option = s_parameter, executor = executor, lookahead = lookahead, cache = cache, warm = warm)
         it = -1
     elif strategy == 'sim':
         if len(s_parameter) < 4:
             print '2 strategies need to be chosen in order to use Simulated Annealing strategy.'
             sys.exit()
-        active_learning_strategy1, it = choosingStrategies(s_parameter[0], classifier, seed, sub_pool, alpha, X_test, y_test, y_pool)
-        active_learning_strategy2, it = choosingStrategies(s_parameter[1], classifier, seed, sub_pool, alpha, X_test, y_test, y_pool)
+        active_learning_strategy1, it = choosingStrategies(s_parameter[0], classifier, seed, sub_pool, alpha, X_test, y_test, y_pool, options = options)
+        active_learning_strategy2, it = choosingStrategies(s_parameter[1], classifier, seed, sub_pool, alpha, X_test, y_test, y_pool, options = options)
         active_s = SimulatedAnnealing(strategy1=active_learning_strategy1, strategy2=active_learning_strategy2, seed=seed, inicial_temperature=float(s_parameter[2]), temperature_step=float(s_parameter[3]))
         it = -1
 
     return active_s, it
 
 '''
-Main function. This function is responsible for training and testing.
+The first step of a trial (pool reduction, bootstrap or s2's whole pool, makeItBetter, first
+fit and evaluation) only depends on the trial seed and on whether the strategy is s2, so with
+options['shared_prefix'] it is computed once per trial and kind and reused by every strategy.
 '''
-def learning(num_trials, X_train, y_train, X_test, strategy, budget, step_size, sub_pool, boot_strap_size, classifier, alpha, y_test, m, s_parameter, mb):
-    accuracies = defaultdict(lambda: [])
-    aucs = defaultdict(lambda: [])
-
-    for t in range(num_trials):
-        if m > 0 and len(y_train) > m:
-            
-            np.random.seed(t)
+def prefixKind(strategy):
+    if strategy == 's2':
+        return 's2'
+    return 'bootstrap'
 
-            rand_indices = np.random.permutation(X_train.shape[0])
-            X_pool = X_train[rand_indices[:m]]
-            y_pool = y_train[rand_indices[:m]]
-            
+'''
+Accuracy and AUC of a fitted model on the test set.
+'''
+def evaluate(model, classifier, X_test, y_test):
+    with timers.phase('evaluation'):
+        # Prediction
+        
+        # Gaussian Naive Bayes requires denses matrizes
+        if (classifier) == type(GaussianNB()):
+            y_probas = model.predict_proba(X_test.toarray())
         else:
-            X_pool = X_train
-            y_pool = y_train
+            y_probas = model.predict_proba(X_test)
 
-        print "trial", t
+        # Metrics
+        auc = metrics.roc_auc_score(y_test, y_probas[:,1])     
+        
+        pred_y = model.classes_[np.argmax(y_probas, axis=1)]
+        
+        accu = metrics.accuracy_score(y_test, pred_y)
 
-        # Gaussian Naive Bayes requires denses matrizes
-        if (classifier) == type(GaussianNB()):
-            X_pool_csr = X_pool.toarray()
+    return accu, auc
+
+'''
+Runs a single trial of the learning curve, seeded by t.
+Returns the list of (train size, accuracy, auc) measured at each step, in order.
+With options['prefix_only'] it stops after the first step and returns its state instead.
+With options['pipeline'], each step is evaluated on a background thread while the next one is
+chosen and fit; the steps are still recorded (curve, stream, checkpoint) in order.
+'''
+def learningTrial(t, X_train, y_train, X_test, strategy, budget, step_size, sub_pool, boot_strap_size, classifier, alpha, y_test, m, s_parameter, mb, options=None):
+    curve = []
+
+    if options is None:
+        options = {}
+
+    prefix = options.get('prefixes', {}).get((prefixKind(strategy), t))
+
+    rand_indices = None
+    if m > 0 and len(y_train) > m:
+        
+        if prefix is not None:
+            rand_indices = prefix['reduction']
         else:
-            X_pool_csr = X_pool.tocsr()
-    
-        pool = set(range(len(y_pool)))
+            np.random.seed(t)
 
-        trainIndices = []
+            rand_indices = np.random.permutation(X_train.shape[0])
+        X_pool = X_train[rand_indices[:m]]
+        y_pool = y_train[rand_indices[:m]]
         
-        bootsrapped = False
-
-        # Choosing strategy
-        # if strategy == 'erreduct':
-        #     active_s = ErrorReductionStrategy(classifier=classifier, seed=t, sub_pool=sub_pool, classifier_args=alpha)
-        # elif strategy == 'loggain':
-        #     active_s = LogGainStrategy(classifier=classifier, seed=t, sub_pool=sub_pool, classifier_args=alpha)
-        # elif strategy == 'qbc':
-        #     active_s = QBCStrategy(classifier=classifier, classifier_args=alpha)
-        # elif strategy == 'rand':    
-        #     active_s = RandomStrategy(seed=t)
-        # elif strategy == 'unc':
-        #     active_s = UncStrategy(seed=t, sub_pool=sub_pool)
-        # elif strategy == 's1':
-        #     active_s = Strategy1(classifier=classifier, seed=t, sub_pool=sub_pool, classifier_args=alpha, X_test = X_test, y_test = y_test, y_pool = y_pool, option = s_parameter)
-        # elif strategy == 's2':
-        #     active_s = Strategy2(classifier=classifier, seed=t, sub_pool=sub_pool, classifier_args=alpha, X_test = X_test, y_test = y_test, y_pool = y_pool, option = s_parameter)
-        #     it = -1
-        # elif strategy == 'sim':
-        #     active_s = SimulatedAnnealing(seed=t)
-        active_s, it = choosingStrategies(strategy, classifier, t, sub_pool, alpha, X_test, y_test, y_pool, s_parameter)
-
-        model = None
-
-        condition = True
-        # Loop for prediction
-        while (condition):
-            if strategy == 's2':
-                it+=1
-                condition = it < budget and len(pool) > step_size
-            else:
-              condition = len(trainIndices) < budget and len(pool) > step_size
+    else:
+        X_pool = X_train
+        y_pool = y_train
+
+    print "trial", t
+
+    # Gaussian Naive Bayes requires denses matrizes
+    if (classifier) == type(GaussianNB()):
+        X_pool_csr = X_pool.toarray()
+    else:
+        X_pool_csr = X_pool.tocsr()
+
+    pool = IndexPool(len(y_pool))
 
+    trainIndices = []
 
-            if condition:
-                
-                if not bootsrapped:
-                    newIndices = []
-                    bootsrapped = True
-                    if not strategy == 's2':
+    # rows of the training set, appended as it grows
+    train = TrainingBuffer(X_pool_csr)
+    
+    bootsrapped = False
+
+    if options.get('utility_cache') is not None and m > 0 and len(y_train) > m:
+        # the indices of a reduced pool only mean something within this trial
+        options = dict(options, utility_cache=options['utility_cache'].scoped('trial%d' % t))
+
+    if options.get('lookahead') == 'warm':
+        # the warm fits of this trial, reported at its end
+        options = dict(options, warm=WarmStarter(options.get('warm_tol'), options.get('warm_max_iter'), options.get('warm_check', 0)))
+
+    active_s, it = choosingStrategies(strategy, classifier, t, sub_pool, alpha, X_test, y_test, y_pool, s_parameter, options)
+
+    model = None
+
+    checkpoint = None
+    if options.get('checkpoint'):
+        config = {'strategy': strategy, 'budget': budget, 'step_size': step_size, 'sub_pool': sub_pool, 'bootstrap': boot_strap_size,
+                  'classifier': classifier.__name__, 'alpha': alpha, 'm': m, 's_parameter': s_parameter, 'mb': mb,
+                  'lookahead': options.get('lookahead', 'refit'), 'mb_batch': options.get('mb_batch', 1), 'disagreement': options.get('disagreement', 'vote'),
+                  'warm_tol': options.get('warm_tol'), 'warm_max_iter': options.get('warm_max_iter'), 'influence_refit': options.get('influence_refit', 0),
+                  'unc_measure': options.get('unc_measure', 'minprob'), 'unc_full_pool': options.get('unc_full_pool', False),
+                  'greedy_batch': options.get('greedy_batch', False), 'racing': options.get('racing', False), 'race_start': options.get('race_start', 256), 'race_confidence': options.get('race_confidence', 0.95),
+                  'pool_shape': X_train.shape, 'test_shape': X_test.shape}
+        checkpoint = TrialCheckpoint(options['checkpoint'], strategy, t, config)
+
+        state = None
+        if options.get('resume'):
+            state = checkpoint.load()
+
+        if state is not None:
+            # Continue after the last completed step, refitting its model from the same random state
+            curve = list(state['curve'])
+            if state['done']:
+                return curve
+            trainIndices = list(state['train_indices'])
+            pool = IndexPool(len(y_pool), state['pool'])
+            it = state['it']
+            bootsrapped = state['bootstrapped']
+            active_s.restoreState(state['strategy_state'])
+            np.random.set_state(state['rng_state'])
+
+            model = classifier(**alpha)
+            if len(set(y_pool[trainIndices])) > 1:
+                model.fit(X_pool_csr[trainIndices], y_pool[trainIndices])
+            print "resuming trial", t, "at train size", len(trainIndices)
+
+    if prefix is not None and not curve:
+        # Start from the shared first step, in the random state it left
+        trainIndices = list(prefix['train_indices'])
+        pool = IndexPool(len(y_pool), prefix['pool'])
+        it = prefix['it']
+        bootsrapped = True
+        model = prefix['model']
+        curve = [prefix['step']]
+        np.random.set_state(prefix['rng_state'])
+
+        if options.get('stream') is not None:
+            options['stream'].write(strategy, t, *curve[0])
+
+        if checkpoint is not None:
+            checkpoint.save({'curve': curve, 'train_indices': trainIndices, 'pool': pool.indices(), 'it': it, 'bootstrapped': bootsrapped,
+                             'strategy_state': active_s.checkpointState(), 'rng_state': prefix['fit_rng_state'], 'done': False})
+
+    evaluator = None
+    if options.get('pipeline') and not options.get('prefix_only'):
+        evaluator = ThreadPool(1)
+
+    # (train size, accuracy and auc or their pending evaluation, checkpoint state) of the unrecorded steps
+    pending = []
+
+    def record(keep):
+        # records the steps in order, but the last keep ones
+        while len(pending) > keep:
+            size, evaluation, state = pending.pop(0)
+            if evaluator is not None and not isinstance(evaluation, tuple):
+                evaluation = evaluation.get()
+            accu, auc = evaluation
+            curve.append((size, accu, auc))
+
+            if options.get('stream') is not None:
+                options['stream'].write(strategy, t, size, accu, auc)
+
+            if checkpoint is not None:
+                checkpoint.save(dict(state, curve=curve))
+
+    condition = True
+    # Loop for prediction
+    while (condition):
+        if strategy == 's2':
+            it+=1
+            condition = it < budget and len(pool) > step_size
+        else:
+          condition = len(trainIndices) < budget and len(pool) > step_size
+
+
+        if condition:
+            
+            if not bootsrapped:
+                newIndices = []
+                bootsrapped = True
+                if not strategy == 's2':
+                    with timers.phase('bootstrap'):
                         boot_s = BootstrapFromEach(t)
                         newIndices = boot_s.bootstrap(pool, y=y_pool, k=boot_strap_size)
-                else:
+            else:
+                with timers.phase('chooseNext'):
                     newIndices = active_s.chooseNext(pool, X_pool_csr, model, k = step_size, current_train_indices = trainIndices, current_train_y = y_pool[trainIndices])
 
-                pool.difference_update(newIndices)
+            pool.difference_update(newIndices)
+
+            if strategy == 's2':
+                trainIndices = np.sort(pool.indices()).tolist()
+            else:
+                trainIndices.extend(newIndices)
+            
+            model = classifier(**alpha)
+            
+            if mb:
+                with timers.phase('makeItBetter'):
+                    trainIndices, pool = makeItBetter(X_pool_csr, y_pool, X_test, y_test, current_train_indices = trainIndices, pool = pool, number_trials = sub_pool, classifier=classifier, alpha=alpha, option='auc', seed=t,
+                                                      batch_size=options.get('mb_batch', 1), executor=options.get('executor'), incremental=options.get('lookahead') == 'nb', cache=options.get('utility_cache'))
+
+            evaluation = (-np.inf, -np.inf)
+
+            # random state the model of this step is fit from
+            rng_state = np.random.get_state()
+
+            if len(set(y_pool[trainIndices])) > 1:
+                with timers.phase('fit'):
+                    train.sync(trainIndices, y_pool[trainIndices])
+                    model.fit(*train.view())
 
-                if strategy == 's2':
-                    trainIndices = list(pool)
+                if evaluator is not None:
+                    # the model of a step is not refit, the next step fits a new one
+                    evaluation = evaluator.apply_async(evaluate, (model, classifier, X_test, y_test))
                 else:
-                    trainIndices.extend(newIndices)
-                
-                model = classifier(**alpha)
-                
-                if mb:
-                    trainIndices, pool = makeItBetter(X_pool_csr, y_pool, X_test, y_test, current_train_indices = trainIndices, pool = list(pool), number_trials = sub_pool, classifier=classifier, alpha=alpha, option='auc', seed=t)
-
-                auc = -np.inf
-                accu = -np.inf
-
-                if len(set(y_pool[trainIndices])) > 1:
-                    model.fit(X_pool_csr[trainIndices], y_pool[trainIndices])
-
-                    
-
-                    # Prediction
-                    
-                    # Gaussian Naive Bayes requires denses matrizes
-                    if (classifier) == type(GaussianNB()):
-                        y_probas = model.predict_proba(X_test.toarray())
-                    else:
-                        y_probas = model.predict_proba(X_test)
-
-                    # Metrics
-                    auc = metrics.roc_auc_score(y_test, y_probas[:,1])     
-                    
-                    pred_y = model.classes_[np.argmax(y_probas, axis=1)]
-                    
-                    accu = metrics.accuracy_score(y_test, pred_y)
-                
-                accuracies[len(trainIndices)].append(accu)
-                aucs[len(trainIndices)].append(auc)
-
-    return accuracies, aucs
+                    evaluation = evaluate(model, classifier, X_test, y_test)
+
+            if options.get('prefix_only'):
+                return {'reduction': rand_indices, 'train_indices': list(trainIndices), 'pool': pool.indices(), 'it': it, 'model': model,
+                        'step': (len(trainIndices), evaluation[0], evaluation[1]), 'fit_rng_state': rng_state, 'rng_state': np.random.get_state()}
+
+            state = None
+            if checkpoint is not None:
+                state = {'train_indices': list(trainIndices), 'pool': pool.indices(), 'it': it, 'bootstrapped': bootsrapped,
+                         'strategy_state': active_s.checkpointState(), 'rng_state': rng_state, 'done': False}
+            pending.append((len(trainIndices), evaluation, state))
+
+            # with the pipeline, this step is recorded once the next one is fit
+            record(1 if evaluator is not None else 0)
+
+    record(0)
+    if evaluator is not None:
+        evaluator.close()
+        evaluator.join()
+
+    if checkpoint is not None:
+        checkpoint.save({'curve': curve, 'done': True})
+
+    if options.get('prefix_only'):
+        # the budget did not allow a first step
+        return None
+
+    if options.get('warm') is not None:
+        print "trial", t, options['warm'].report()
+
+    return curve
+
+# Arguments shared by the worker processes of learning(), set before forking
+_trial_args = None
+
+def _initTrialWorker(args):
+    global _trial_args
+    _trial_args = args
+
+def _runTrial(t):
+    # the phases of the trial go back to the parent with its curve
+    timers.reset()
+    curve = learningTrial(t, *_trial_args)
+    return curve, timers.snapshot()
+
+def _runPrefix(task):
+    kind, t = task
+    return learningTrial(t, *_trial_args[kind])
+
+'''
+Computes the shared first steps of the trials of the given kinds that options['prefixes']
+still misses, over jobs processes, and stores them there for learningTrial.
+'''
+def sharePrefixes(kinds, num_trials, X_train, y_train, X_test, budget, step_size, sub_pool, boot_strap_size, classifier, alpha, y_test, m, s_parameter, mb, jobs=1, options=None):
+    prefixes = options.setdefault('prefixes', {})
+    tasks = [(kind, t) for kind in kinds for t in range(num_trials) if not (kind, t) in prefixes]
+    if not tasks:
+        return
+
+    # nothing of the prefix runs is streamed or checkpointed, the strategies do it when they reuse them
+    prefix_options = dict(options, prefix_only=True, prefixes={}, stream=None, checkpoint='')
+    args = {}
+    for kind in kinds:
+        strategy = 's2' if kind == 's2' else 'rand'
+        args[kind] = (X_train, y_train, X_test, strategy, budget, step_size, sub_pool, boot_strap_size, classifier, alpha, y_test, m, s_parameter, mb, prefix_options)
+
+    if jobs > 1 and len(tasks) > 1:
+        workers = Pool(processes=min(jobs, len(tasks)), initializer=_initTrialWorker, initargs=(args,))
+        try:
+            results = workers.map(_runPrefix, tasks, chunksize=1)
+        finally:
+            workers.close()
+            workers.join()
+    else:
+        results = [learningTrial(t, *args[kind]) for kind, t in tasks]
+
+    for task, prefix in zip(tasks, results):
+        if prefix is not None:
+            prefixes[task] = prefix
+
+'''
+Main function. This function is responsible for training and testing.
+Each trial only depends on its seed, so with jobs > 1 the trials are spread over
+worker processes; the curves are merged back in trial order, matching the serial run,
+and the phase timings of the workers are added to timers.
+Returns the (train size, accuracy, auc) curve of each trial, in trial order (see ResultsStore.addCurves).
+'''
+def learning(num_trials, X_train, y_train, X_test, strategy, budget, step_size, sub_pool, boot_strap_size, classifier, alpha, y_test, m, s_parameter, mb, jobs=1, options=None):
+    if options is not None and options.get('shared_prefix'):
+        sharePrefixes([prefixKind(strategy)], num_trials, X_train, y_train, X_test, budget, step_size, sub_pool, boot_strap_size, classifier, alpha, y_test, m, s_parameter, mb, jobs, options)
+
+    args = (X_train, y_train, X_test, strategy, budget, step_size, sub_pool, boot_strap_size, classifier, alpha, y_test, m, s_parameter, mb, options)
+
+    if jobs > 1 and num_trials > 1:
+        workers = Pool(processes=min(jobs, num_trials), initializer=_initTrialWorker, initargs=(args,))
+        try:
+            results = workers.map(_runTrial, range(num_trials), chunksize=1)
+        finally:
+            workers.close()
+            workers.join()
+
+        curves = []
+        for curve, snapshot in results:
+            curves.append(curve)
+            timers.merge(snapshot)
+    else:
+        curves = [learningTrial(t, *args) for t in range(num_trials)]
+
+    return curves
+
+def _runStrategy(queue, data_dir, strategy, args):
+    try:
+        X_train, y_train = loadCSR(os.path.join(data_dir, 'pool'))
+        X_test, y_test = loadCSR(os.path.join(data_dir, 'test'))
+        num_trials, budget, step_size, sub_pool, boot_strap_size, classifier, alpha, m, s_parameter, mb, jobs, options = args
+
+        timers.reset()
+        t0 = time()
+        curves = learning(num_trials, X_train, y_train, X_test, strategy, budget, step_size, sub_pool, boot_strap_size, classifier, alpha, y_test, m, s_parameter, mb, jobs, options)
+        queue.put((strategy, curves, time() - t0, timers.snapshot(), None))
+    except Exception:
+        queue.put((strategy, None, None, None, traceback.format_exc()))
+
+'''
+Runs learning() for each strategy in its own process, at most `processes` at a time.
+The pool and test matrices are written once to a temporary directory and memory-mapped
+read-only by every worker, so they are shared instead of copied per strategy.
+The workers are not daemons, so each one can still spread its trials over --jobs processes.
+Returns the curves (as learning() does), durations and phase timings keyed by strategy.
+'''
+def learningConcurrent(strategies, processes, num_trials, X_train, y_train, X_test, budget, step_size, sub_pool, boot_strap_size, classifier, alpha, y_test, m, s_parameter, mb, jobs=1, options=None):
+    curves = {}
+    duration = {}
+    phases = {}
+
+    if options is not None and options.get('shared_prefix'):
+        # computed before forking, so every strategy inherits them
+        kinds = sorted(set(prefixKind(strategy) for strategy in strategies))
+        sharePrefixes(kinds, num_trials, X_train, y_train, X_test, budget, step_size, sub_pool, boot_strap_size, classifier, alpha, y_test, m, s_parameter, mb, jobs, options)
+
+    data_dir = tempfile.mkdtemp(prefix='learning_curve-')
+    try:
+        os.mkdir(os.path.join(data_dir, 'pool'))
+        os.mkdir(os.path.join(data_dir, 'test'))
+        saveCSR(os.path.join(data_dir, 'pool'), X_train, y_train)
+        saveCSR(os.path.join(data_dir, 'test'), X_test, y_test)
+
+        args = (num_trials, budget, step_size, sub_pool, boot_strap_size, classifier, alpha, m, s_parameter, mb, jobs, options)
+        queue = Queue()
+        waiting = list(strategies)
+        running = {}
+
+        while waiting or running:
+            while waiting and len(running) < processes:
+                strategy = waiting.pop(0)
+                running[strategy] = Process(target=_runStrategy, args=(queue, data_dir, strategy, args))
+                running[strategy].start()
+
+            try:
+                strategy, curve, elapsed, snapshot, error = queue.get(timeout=1)
+            except Empty:
+                # a worker killed before reporting would otherwise be waited for forever
+                for strategy, worker in running.items():
+                    if worker.exitcode is not None and worker.exitcode != 0:
+                        raise RuntimeError("Strategy %s exited with code %d" % (strategy, worker.exitcode))
+                continue
+
+            running.pop(strategy).join()
+            if error is not None:
+                raise RuntimeError("Strategy %s failed:\n%s" % (strategy, error))
+
+            curves[strategy] = curve
+            duration[strategy] = elapsed
+            phases[strategy] = snapshot
+
+            print
+            print "%s Learning curve took %0.2fs." % (strategy, elapsed)
+            print
+    finally:
+        shutil.rmtree(data_dir)
+
+    return curves, duration, phases
     
 
 if (__name__ == '__main__'):
@@ -250,11 +615,25 @@ if (__name__ == '__main__'):
     parser.add_argument("-sd", '--sdata', type=str, default='',
                         help='Single file that contains the data, it will be splitted (default: None).')
 
+    # Binary cache of the data files
+    parser.add_argument("-cd", '--cache_dir', type=str, default='',
+                        help='Directory where the svmlight files are cached in binary form on first load and memory-mapped \
+                        afterwards. If it is left blank, the files are parsed on every run (default: '' ).')
+
     # File: Name of file that will be written the results
     parser.add_argument("-f", '--file', type=str, default='',
                         help='This feature represents the name that will be written with the result. \
                         If it is left blank, the file will not be written (default: '' ).')
 
+    # File: results streamed as they are computed
+    parser.add_argument("-sf", '--stream', type=str, default='',
+                        help='File every (strategy, trial, train size) result is appended to as soon as it is computed, \
+                        as CSV if it ends in .csv and JSON lines otherwise; aggregate it with results.py (default: '' ).')
+
+    parser.add_argument("-rs", '--results_store', type=str, default='',
+                        help='File the results of all strategies are saved to as a ResultsStore (.npz) with the settings of \
+                        the run, to be merged and compared with results.py (default: '' ).')
+
     # Number of Trials
     parser.add_argument("-nt", "--num_trials", type=int, default=10, help="Number of trials (default: 10).")
 
@@ -286,43 +665,172 @@ if (__name__ == '__main__'):
 
     parser.add_argument("-mb", "--makeitbetter", action="store_true")    
 
+    # Swaps proposed and scored together by each round of makeItBetter
+    parser.add_argument("-mbb", "--mb_batch", default=1, type=int,
+                        help='Number of swaps scored per round of --makeitbetter, the best improving one is kept (default: 1).')
 
-    # Parsing args
-    args = parser.parse_args()
+    # Checkpoints
+    parser.add_argument("-ck", "--checkpoint", type=str, default='',
+                        help='Directory where the state of every trial is saved after each step. If it is left blank, \
+                        nothing is saved (default: '' ).')
 
-    # args.classifier is a string, eval makes it a class
-    classifier = eval((args.classifier))
+    parser.add_argument("-r", "--resume", action="store_true",
+                        help='Resume the trials saved in --checkpoint from their last completed step.')
 
-    # Parsing classifier's arguments
-    model_arguments = args.arguments.split(',')
+    # Number of worker processes the trials are spread over
+    parser.add_argument("-j", "--jobs", default=1, type=int,
+                        help='Number of trials run in parallel, each in its own process (default: 1).')
 
-    alpha = {}
+    # Number of strategies run at the same time
+    parser.add_argument("-sj", "--strategy_jobs", default=1, type=int,
+                        help='Number of strategies run concurrently, each in its own process sharing memory-mapped \
+                        copies of the pool and test data (default: 1).')
 
-    for argument in model_arguments:
-        if argument.find('=') >= 0:
-            index, value = argument.split('=')
-            alpha[index] = eval(value)
+    # Concurrent scoring of the lookahead candidates of strategies 1 and 2
+    parser.add_argument("-cj", "--candidate_jobs", default=1, type=int,
+                        help='Number of workers scoring the candidates of s1 and s2 concurrently (default: 1).')
 
-    # Two formats of data are possible, split into training and testing or not split
-    if args.sdata:
-        # Not Split, single file
-        data = args.sdata
-        
-        X, y = load_svmlight_file(data)
+    parser.add_argument("-ex", "--executor", choices=['thread', 'process'], default='thread',
+                        help='Kind of workers used by --candidate_jobs (default: thread).')
 
-        # Splitting 2/3 of data as training data and 1/3 as testing
-        # Data selected randomly
-        X_pool, X_test, y_pool, y_test = train_test_split(X, y, test_size=(1./3.), random_state=42)
+    # How s1, loggain and erreduct compute the models of their hypothetical training sets
+    parser.add_argument("-la", "--lookahead", choices=LOOKAHEADS, default='refit',
+                        help='refit fits a classifier per hypothetical training set, nb updates the counts of MultinomialNB/BernoulliNB, \
+                        warm starts the fits from the current solution of iterative classifiers, e.g. LogisticRegression \
+                        with solver lbfgs, newton-cg, sag or saga, influence approximates the refits of LogisticRegression \
+                        by a Newton step from the current solution, for all candidates at once. s2 takes refit, nb or warm \
+                        and --makeitbetter refit or nb (default: refit).')
 
-    else:
-        # Split data
-        data_pool = args.data[0]
-        data_test = args.data[1]
+    parser.add_argument("-wt", "--warm_tol", default=None, type=float,
+                        help='Tolerance of the warm-started fits (default: the classifier\'s).')
 
-        X_pool, y_pool = load_svmlight_file(data_pool)
-        num_pool, num_feat = X_pool.shape
+    parser.add_argument("-wmi", "--warm_max_iter", default=None, type=int,
+                        help='Iteration cap of the warm-started fits (default: the classifier\'s).')
+
+    parser.add_argument("-wc", "--warm_check", default=0, type=int,
+                        help='Fit every n-th warm-started set cold too and report the gap between both per trial (default: 0, never).')
+
+    parser.add_argument("-ier", "--influence_refit", default=0, type=int,
+                        help='Number of the best candidates of the influence lookahead rescored by exact refits (default: 0).')
+
+    # Committee disagreement of qbc
+    parser.add_argument("-qd", "--qbc_disagreement", choices=['vote', 'kl'], default='vote',
+                        help='vote entropy of the hard votes, or mean KL divergence of the soft votes (default: vote).')
+
+    # Uncertainty sampling
+    parser.add_argument("-um", "--unc_measure", choices=['minprob', 'margin', 'entropy'], default='minprob',
+                        help='Uncertainty unc selects by: smallest class probability, margin between the two most likely \
+                        classes or entropy of the prediction (default: minprob).')
+
+    parser.add_argument("-ufp", "--unc_full_pool", action="store_true",
+                        help='Make unc score the whole pool, in chunks of --unc_chunk_size rows, instead of a random sub pool.')
+
+    parser.add_argument("-ucs", "--unc_chunk_size", default=1000, type=int,
+                        help='Rows per predict_proba call of --unc_full_pool (default: 1000).')
 
-        X_test, y_test = load_svmlight_file(data_test, n_features=num_feat)
+    # Racing of the s1 candidates
+    parser.add_argument("-rc", "--racing", action="store_true",
+                        help='Score the candidates of s1 on growing subsets of the test set, dropping the ones that are \
+                        confidently worse than the best step_size after each round (successive halving for auc).')
+
+    parser.add_argument("-rcs", "--race_start", default=256, type=int,
+                        help='Test rows the first round of --racing scores the candidates on, doubled each round (default: 256).')
+
+    parser.add_argument("-rcc", "--race_confidence", default=0.95, type=float,
+                        help='Confidence of the intervals --racing drops candidates with (default: 0.95).')
+
+    # Batches of s1
+    parser.add_argument("-gb", "--greedy_batch", action='store_true',
+                        help='s1 chooses each step\'s instances one at a time against the set extended with the ones already chosen, \
+                        rescoring lazily the candidates on top of a heap, instead of taking the top step size of a single pass.')
+
+    # Evaluation of the steps
+    parser.add_argument("-pe", "--pipeline", action='store_true',
+                        help='Evaluate each step on the test set in a background thread while the next step is chosen and fit. \
+                        Cannot be combined with --executor process, whose workers could fork while that thread holds the timing lock.')
+
+    # First step shared by the strategies
+    parser.add_argument("-spx", "--shared_prefix", action="store_true",
+                        help='Compute the first step of each trial (pool reduction, bootstrap, makeItBetter, first fit and \
+                        evaluation) once and reuse it for every strategy.')
+
+    # Memoized utilities
+    parser.add_argument("-uc", "--utility_cache", default=0, type=int,
+                        help='Number of training-set utilities of s1, s2 and makeItBetter kept in an LRU cache, so sets \
+                        scored again are not refit. 0 disables it (default: 0). Cannot be combined with --executor process, \
+                        whose workers would fill and consult copies of the cache that are lost when they exit.')
+
+    # Per-phase timing
+    parser.add_argument("-tm", "--timing", nargs='?', const='-', default=None,
+                        help='Print the wall time and calls of each phase (sampling, fits, predictions, utilities, bootstrap, \
+                        makeItBetter, evaluation) per strategy; given a file name, also save them to it as JSON (default: off).')
+
+
+    # Parsing args
+    args = parser.parse_args()
+
+    if args.jobs > 1 and args.candidate_jobs > 1 and args.executor == 'process':
+        parser.error('--executor process cannot be combined with --jobs, the trial workers cannot fork their own.')
+
+    if args.utility_cache > 0 and args.candidate_jobs > 1 and args.executor == 'process':
+        parser.error('--executor process cannot be combined with --utility_cache, its workers would only cache in their own copies.')
+
+    if args.pipeline and args.candidate_jobs > 1 and args.executor == 'process':
+        parser.error('--executor process cannot be combined with --pipeline, its workers could fork while the evaluation thread holds a lock.')
+
+    # Optional settings of the strategies
+    options = {}
+    options['executor'] = makeExecutor(args.executor, args.candidate_jobs)
+    options['lookahead'] = args.lookahead
+    options['disagreement'] = args.qbc_disagreement
+    options['mb_batch'] = args.mb_batch
+    options['checkpoint'] = args.checkpoint
+    options['resume'] = args.resume
+    options['stream'] = ResultsWriter(args.stream) if args.stream else None
+    options['unc_measure'] = args.unc_measure
+    options['unc_full_pool'] = args.unc_full_pool
+    options['unc_chunk_size'] = args.unc_chunk_size
+    options['racing'] = args.racing
+    options['race_start'] = args.race_start
+    options['race_confidence'] = args.race_confidence
+    options['greedy_batch'] = args.greedy_batch
+    options['pipeline'] = args.pipeline
+    options['shared_prefix'] = args.shared_prefix
+    options['warm_tol'] = args.warm_tol
+    options['warm_max_iter'] = args.warm_max_iter
+    options['warm_check'] = args.warm_check
+    options['influence_refit'] = args.influence_refit
+    options['utility_cache'] = UtilityCache(args.utility_cache) if args.utility_cache > 0 else None
+
+    if args.resume and not args.checkpoint:
+        parser.error('--resume requires --checkpoint.')
+
+    # args.classifier is a string, eval makes it a class
+    classifier = eval((args.classifier))
+
+    # Parsing classifier's arguments
+    alpha = classifierArguments(args.arguments)
+
+    # --lookahead applies to every strategy of the run, so a bad combination fails before any of them starts
+    checked = list(args.strategies)
+    if 'sim' in checked:
+        checked.extend(args.p[:2])
+    for strategy in checked:
+        if strategy in STRATEGY_LOOKAHEADS:
+            try:
+                checkLookahead(args.lookahead, classifier, STRATEGY_LOOKAHEADS[strategy])
+            except ValueError as error:
+                parser.error('%s: %s' % (strategy, error))
+    if args.makeitbetter:
+        try:
+            checkLookahead(args.lookahead, classifier, MAKEITBETTER_LOOKAHEADS)
+        except ValueError as error:
+            parser.error('--makeitbetter: %s' % error)
+
+    if args.lookahead == 'warm' and not supportsWarmStart(classifier, alpha):
+        print "%s cannot be warm-started with these arguments, the warm lookahead fits it cold." % args.classifier
+
+    X_pool, y_pool, X_test, y_test = loadData(args.data, args.sdata, args.cache_dir)
 
     duration = time() - t0
 
@@ -342,10 +850,8 @@ if (__name__ == '__main__'):
     
     duration = defaultdict(lambda: 0.0)
 
-    accuracies = defaultdict(lambda: [])
-    
-    aucs = defaultdict(lambda: [])    
-    
+    phases = {}
+
     num_test = X_test.shape[0]
 
     m = args.m
@@ -358,20 +864,43 @@ if (__name__ == '__main__'):
         print 'one argument'
         s_parameter = s_parameter[0]
 
+    # Settings saved along the results
+    metadata = {'data': args.sdata or args.data, 'classifier': args.classifier, 'arguments': alpha, 'num_trials': num_trials,
+                'budget': budget, 'stepsize': step_size, 'subpool': sub_pool, 'bootstrap': boot_strap_size, 'm': m, 'p': s_parameter,
+                'makeitbetter': args.makeitbetter, 'lookahead': args.lookahead}
+    results = ResultsStore(metadata)
+
     # Main Loop
-    for strategy in strategies:
-        t0 = time()
+    if args.strategy_jobs > 1 and len(strategies) > 1:
+        curves, duration, phases = learningConcurrent(strategies, args.strategy_jobs, num_trials, X_pool, y_pool, X_test, budget, step_size, sub_pool, boot_strap_size, classifier, alpha, y_test, m, s_parameter, args.makeitbetter, jobs=args.jobs, options=options)
+        for strategy in strategies:
+            results.addCurves(strategy, curves[strategy])
+
+    else:
+        for strategy in strategies:
+            t0 = time()
+            timers.reset()
 
-        accuracies[strategy], aucs[strategy] = learning(num_trials, X_pool, y_pool, X_test, strategy, budget, step_size, sub_pool, boot_strap_size, classifier, alpha, y_test, m, s_parameter, args.makeitbetter)
+            curves = learning(num_trials, X_pool, y_pool, X_test, strategy, budget, step_size, sub_pool, boot_strap_size, classifier, alpha, y_test, m, s_parameter, args.makeitbetter, jobs=args.jobs, options=options)
 
-        duration[strategy] = time() - t0
+            results.addCurves(strategy, curves)
 
-        print
-        print "%s Learning curve took %0.2fs." % (strategy, duration[strategy])
-        print
+            duration[strategy] = time() - t0
+            phases[strategy] = timers.snapshot()
+
+            print
+            print "%s Learning curve took %0.2fs." % (strategy, duration[strategy])
+            print
     
     
-    values = sorted(accuracies[strategies[0]].keys())
+    values = results.trainSizes(strategies[0])
+
+    # mean per train size of each strategy and metric
+    means = {}
+    for strategy in strategies:
+        for metric in ['accuracy', 'auc']:
+            sizes, mean = results.summary(strategy, metric)[:2]
+            means[strategy, metric] = dict(zip(sizes, mean))
 
     # print the accuracies
     print
@@ -384,7 +913,7 @@ if (__name__ == '__main__'):
     for value in values:
         print "%d\t\t" % value,
         for strategy in strategies:
-            print "%0.3f\t\t" % np.mean(accuracies[strategy][value]),
+            print "%0.3f\t\t" % means[strategy, 'accuracy'].get(value, np.nan),
         print
         
     # print the aucs
@@ -398,9 +927,17 @@ if (__name__ == '__main__'):
     for value in values:
         print "%d\t\t" % value,
         for strategy in strategies:
-            print "%0.3f\t\t" % np.mean(aucs[strategy][value]),
+            print "%0.3f\t\t" % means[strategy, 'auc'].get(value, np.nan),
         print
 
+    # print the areas under the learning curves
+    print
+    print "\tArea under the learning curve (mean over trials)"
+    print "Strategy\tAccuracy\tAUC"
+
+    for strategy in strategies:
+        print "%s\t%0.3f\t\t%0.3f" % (strategy, np.mean(results.aulc(strategy, 'accuracy')), np.mean(results.aulc(strategy, 'auc')))
+
     # print the times
     print
     print "\tTime"
@@ -409,74 +946,37 @@ if (__name__ == '__main__'):
     for strategy in strategies:
         print "%s\t%0.2f" % (strategy, duration[strategy])
 
+    # print the cache hits
+    if options['utility_cache'] is not None:
+        print
+        print "\tUtility cache"
+        print "Strategy\tHits\tMisses"
+
+        for strategy in strategies:
+            hits = phases[strategy].get('utility_cache.hit', {'calls': 0})['calls']
+            misses = phases[strategy].get('utility_cache.miss', {'calls': 0})['calls']
+            print "%s\t%d\t%d" % (strategy, hits, misses)
+
+    # print the phases
+    if args.timing is not None:
+        for strategy in strategies:
+            print
+            print "\tPhases of %s" % strategy
+            print summary(phases[strategy])
+
+        if args.timing != '-':
+            dump(phases, args.timing)
+
     # Creates file, if asked
     if filename:
         doc = open(filename, 'w')
 
-    # plotting
     for strategy in strategies:
-        accuracy = accuracies[strategy]
-        auc = aucs[strategy]
-
-        # Plotting Accuracy
-        x = sorted(accuracy.keys())
-        y = [np.mean(accuracy[xi]) for xi in x]
-        # z = [np.std(accuracy[xi]) for xi in x]
-        z = []
-        for xi in x:
-            std = []
-            for elem in accuracy[xi]:
-                aux = elem
-                if np.isinf(elem):
-                    aux = 0
-                std.append(aux)
-            z.append(np.std(std))
-        e = np.array(z) / math.sqrt(num_trials)
-
-        # plt.figure(1)
-        # plt.subplot(211)
-        # plt.plot(x, y, '-', label=strategy)
-        # plt.legend(loc='best')
-        # plt.title('Accuracy')
-
-        # Saves all accuracies into a file
         if filename:
-            doc.write(strategy+'\n'+'accuracy'+'\n')
-            doc.write('train size,mean,standard deviation,standard error'+'\n')
-            # print len(values),len(y), len(z), len(e)
-            # print
-            for i in range(len(y)):
-                doc.write("%d,%f,%f,%f\n" % (values[i], y[i], z[i], e[i]))
-            doc.write('\n')
-
-        # Plotting AUC
-        x = sorted(auc.keys())
-        y = [np.mean(auc[xi]) for xi in x]
-        # z = [np.std(auc[xi]) for xi in x]
-        z = []
-        for xi in x:
-            std = []
-            for elem in auc[xi]:
-                aux = elem
-                if np.isinf(elem):
-                    aux = 0
-                std.append(aux)
-            z.append(np.std(std))
-        e = np.array(z) / math.sqrt(num_trials)
-          
-
-        # plt.subplot(212)
-        # plt.plot(x, y, '-', label=strategy)
-        # plt.legend(loc='best')
-        # plt.title('AUC')
-
-        # Saves all acus into a file
-        if filename:
-            doc.write('AUC'+'\n')
-            doc.write('train size,mean,standard deviation,standard error'+'\n')
-            for i in range(len(y)):
-                doc.write("%d,%f,%f,%f\n" % (values[i], y[i], z[i], e[i]))
-            doc.write('\n\n\n')
+            results.writeSummary(doc, strategy, num_trials)
+
+    if args.results_store:
+        results.save(args.results_store)
 
     if filename:
         doc.close()
@@ -0,0 +1,367 @@
+'''
+Lookahead engines, computing the predictions of "current model + candidate" without
+refitting a classifier for every hypothetical training set.
+'''
+
+import threading
+
+import numpy as np
+import scipy.sparse as ss
+
+from scipy.linalg import cho_factor, cho_solve
+from scipy.special import expit
+from sklearn.linear_model import LogisticRegression
+from sklearn.naive_bayes import MultinomialNB, BernoulliNB
+from sklearn.preprocessing import binarize
+
+from timing import timers
+
+
+"""
+Engines share the classes of the current training set (classes) and their counts (class_count).
+"""
+class LookaheadEngine(object):
+
+    def numClasses(self, added=(), removed=()):
+        """ Number of classes left with instances after adding and removing rows with the given labels. """
+        class_count = self.class_count.copy()
+        for label in added:
+            class_count[np.searchsorted(self.classes, label)] += 1
+        for label in removed:
+            class_count[np.searchsorted(self.classes, label)] -= 1
+        return np.sum(class_count > 0)
+
+
+"""
+Naive Bayes lookahead based on sufficient statistics.
+A MultinomialNB/BernoulliNB model is just class counts plus per class feature counts,
+so adding (or removing) rows only changes the counts of their classes. The engine fits
+the current training set once and, for each candidate, derives the posterior of the
+updated model on an evaluation set from the counts: the dense part of the joint log
+likelihood is computed once per class and each candidate adds a sparse correction
+restricted to its own features.
+"""
+class NBLookahead(LookaheadEngine):
+
+    def __init__(self, classifier, classifier_args, X, y):
+        if not classifier in (MultinomialNB, BernoulliNB):
+            raise ValueError("NB lookahead requires MultinomialNB or BernoulliNB, got %s" % classifier.__name__)
+
+        self.model = classifier(**classifier_args)
+        with timers.phase('lookahead.fit'):
+            self.model.fit(X, y)
+
+        self.bernoulli = classifier == BernoulliNB
+        self.classes = self.model.classes_
+        self.alpha = self.model.alpha
+        self.feature_count = np.asarray(self.model.feature_count_, dtype=np.float64)
+        self.class_count = np.asarray(self.model.class_count_, dtype=np.float64)
+        self.num_features = self.feature_count.shape[1]
+
+    def supports(self, labels):
+        # Labels outside the fitted classes would change the set of classes of the model
+        return np.all(np.in1d(labels, self.classes))
+
+    def _binarize(self, X):
+        if self.bernoulli and self.model.binarize is not None:
+            return binarize(X, threshold=self.model.binarize)
+        return X
+
+    def _classLogPrior(self, class_count):
+        if self.model.class_prior is not None:
+            return np.log(np.asarray(self.model.class_prior, dtype=np.float64))
+        elif self.model.fit_prior:
+            # The normalizer is shared by every class, it cancels in predict_proba
+            return np.log(class_count)
+        return np.zeros(len(self.classes))
+
+    def _deltas(self, updates, num_candidates):
+        # Per class, the (candidates x features) count changes and the class count changes
+        deltas = []
+        for ci, c in enumerate(self.classes):
+            D = ss.csr_matrix((num_candidates, self.num_features))
+            dn = np.zeros(num_candidates)
+            for X_rows, labels, sign in updates:
+                weights = sign * (np.asarray(labels) == c).astype(np.float64)
+                if np.any(weights):
+                    D = D + ss.diags(weights, 0).dot(self._binarize(ss.csr_matrix(X_rows)))
+                    dn += weights
+            D = ss.csr_matrix(D)
+            D.eliminate_zeros()
+            deltas.append((D, dn))
+        return deltas
+
+    def _jointLogLikelihood(self, X_eval, updates, num_candidates):
+        jll = np.empty((num_candidates, X_eval.shape[0], len(self.classes)))
+        deltas = self._deltas(updates, num_candidates)
+
+        for ci in range(len(self.classes)):
+            D, dn = deltas[ci]
+            fc = self.feature_count[ci]
+            cc = self.class_count[ci]
+            rows = np.repeat(np.arange(num_candidates), np.diff(D.indptr))
+            fc_nz = fc[D.indices]
+
+            if self.bernoulli:
+                # feature_log_prob - neg_prob = log(fc + alpha) - log(cc + alpha - fc)
+                nz = np.log(fc_nz + D.data + self.alpha) - np.log(cc + dn[rows] + self.alpha - fc_nz - D.data)
+                nz -= np.log(fc_nz + self.alpha) - np.log(cc + dn[rows] + self.alpha - fc_nz)
+                neg_nz = np.log(cc + dn[rows] + self.alpha - fc_nz - D.data) - np.log(cc + dn[rows] + self.alpha - fc_nz)
+                neg_correction = np.bincount(rows, weights=neg_nz, minlength=num_candidates)
+
+                for d in np.unique(dn):
+                    same = dn == d
+                    base = X_eval.dot(np.log(fc + self.alpha) - np.log(cc + d + self.alpha - fc))
+                    neg_sum = np.sum(np.log(cc + d + self.alpha - fc)) - self.num_features * np.log(cc + d + 2 * self.alpha)
+                    jll[same, :, ci] = base + neg_sum
+                jll[:, :, ci] += neg_correction[:, np.newaxis]
+            else:
+                nz = np.log(fc_nz + D.data + self.alpha) - np.log(fc_nz + self.alpha)
+                total = fc.sum() + np.asarray(D.sum(axis=1)).ravel()
+                base = X_eval.dot(np.log(fc + self.alpha))
+                row_sums = np.asarray(X_eval.sum(axis=1)).ravel()
+                jll[:, :, ci] = base - np.outer(np.log(total + self.alpha * self.num_features), row_sums)
+
+            correction = ss.csr_matrix((nz, D.indices, D.indptr), shape=D.shape)
+            jll[:, :, ci] += X_eval.dot(correction.T).toarray().T
+
+        log_prior = self._classLogPrior(self.class_count + np.column_stack([dn for D, dn in deltas]))
+        if log_prior.ndim == 2:
+            log_prior = log_prior[:, np.newaxis, :]
+        jll += log_prior
+
+        return jll
+
+    """
+    Yields (start, probs) for consecutive chunks of candidates, probs having shape
+    (chunk, num_eval, num_classes). Candidate j applies sign * X_rows[j] with label
+    labels[j] for each (X_rows, labels, sign) in updates; sign is 1 to add the row
+    to the training set and -1 to remove it.
+    """
+    def iterPredictProba(self, X_eval, updates, chunk_size=64):
+        num_candidates = updates[0][0].shape[0]
+        X_eval = ss.csr_matrix(self._binarize(X_eval))
+
+        for start in range(0, num_candidates, chunk_size):
+            end = min(start + chunk_size, num_candidates)
+            chunk = [(X_rows[start:end], np.asarray(labels)[start:end], sign) for X_rows, labels, sign in updates]
+
+            with timers.phase('lookahead.predict_proba'), np.errstate(divide='ignore', invalid='ignore'):
+                jll = self._jointLogLikelihood(X_eval, chunk, end - start)
+                top = np.max(jll, axis=2)[:, :, np.newaxis]
+                log_norm = top + np.log(np.sum(np.exp(jll - top), axis=2))[:, :, np.newaxis]
+                probs = np.exp(jll - log_norm)
+
+            yield start, probs
+
+
+"""
+Influence-function lookahead for binary L2 LogisticRegression.
+The model minimizes 0.5 |w|^2 + C sum_i logloss(x_i.w), x including the intercept column, and
+adding (or removing) a row x with label y moves its solution by about one Newton step,
+    dw = -s C r H^-1 x / (1 + s C d x'H^-1 x),
+with s = +1 (-1), r = p(x) - y, d = p(x)(1 - p(x)) and H = I + C X'DX the Hessian at the current
+solution (Sherman-Morrison on H plus the new row). H^-1 is applied through Woodbury,
+H^-1 = I - A'(I + AA')^-1 A with A = sqrt(CD) X, so only an (n x n) system over the training
+rows is factored and the new logits of a whole chunk of candidates on an evaluation set are two
+matrix products. Updates of several rows (a swap) add up their steps. The intercept is treated
+as regularized, as liblinear does; other solvers leave it free, which the step only approximates.
+"""
+class InfluenceLookahead(LookaheadEngine):
+
+    def __init__(self, classifier, classifier_args, X, y):
+        if not classifier is LogisticRegression:
+            raise ValueError("Influence lookahead requires LogisticRegression, got %s" % classifier.__name__)
+
+        self.model = classifier(**classifier_args)
+        if self.model.penalty != 'l2':
+            raise ValueError("Influence lookahead requires the l2 penalty, got %s" % self.model.penalty)
+        with timers.phase('lookahead.fit'):
+            self.model.fit(X, y)
+
+        self.classes = self.model.classes_
+        self.class_count = np.array([np.sum(np.asarray(y) == c) for c in self.classes], dtype=np.float64)
+        if len(self.classes) != 2:
+            return
+
+        self.C = self.model.C
+        self.intercept = 0.
+        if self.model.fit_intercept:
+            # liblinear fits the intercept as the weight of a constant feature of value intercept_scaling
+            self.intercept = self.model.intercept_scaling if self.model.solver == 'liblinear' else 1.
+        self.w = np.append(self.model.coef_.ravel(), self.model.intercept_[0] / self.intercept if self.intercept else 0.)
+
+        self.X = self._augment(X)
+        p = expit(self.X.dot(self.w))
+        self.scale = np.sqrt(self.C * p * (1 - p))
+        A = ss.diags(self.scale).dot(self.X)
+        self.A = A
+        self.factor = cho_factor(np.eye(A.shape[0]) + A.dot(A.T).toarray())
+
+    def supports(self, labels):
+        # binary models only, labels outside the fitted classes would change the set of classes
+        return len(self.classes) == 2 and np.all(np.in1d(labels, self.classes))
+
+    def _augment(self, X):
+        X = ss.csr_matrix(X, dtype=np.float64)
+        return ss.hstack([X, np.repeat(self.intercept, X.shape[0])[:, np.newaxis]], format='csr')
+
+    def _logitDeltas(self, X_eval, B_eval, X_rows, labels, sign):
+        X_rows = self._augment(X_rows)
+        p = expit(X_rows.dot(self.w))
+        r = p - (np.asarray(labels) == self.classes[1])
+        d = p * (1 - p)
+
+        AV = self.A.dot(X_rows.T).toarray()
+        MAV = cho_solve(self.factor, AV)
+        # x'H^-1 x and X_eval H^-1 x of each row
+        q = np.asarray(X_rows.multiply(X_rows).sum(axis=1)).ravel() - np.sum(AV * MAV, axis=0)
+        T = X_eval.dot(X_rows.T).toarray() - B_eval.dot(MAV)
+
+        denominator = np.maximum(1 + sign * self.C * d * q, np.finfo(np.float64).eps)
+        return T * (-sign * self.C * r / denominator)
+
+    """
+    Same as NBLookahead.iterPredictProba: yields (start, probs), probs[j] being the predict_proba
+    on X_eval of the model updated with row start + j of every (X_rows, labels, sign) of updates.
+    """
+    def iterPredictProba(self, X_eval, updates, chunk_size=64):
+        num_candidates = updates[0][0].shape[0]
+        X_eval = self._augment(X_eval)
+        logits = X_eval.dot(self.w)
+        B_eval = X_eval.dot(self.A.T).toarray()
+
+        for start in range(0, num_candidates, chunk_size):
+            end = min(start + chunk_size, num_candidates)
+
+            with timers.phase('lookahead.predict_proba'):
+                new_logits = np.repeat(logits[:, np.newaxis], end - start, axis=1)
+                for X_rows, labels, sign in updates:
+                    new_logits += self._logitDeltas(X_eval, B_eval, X_rows[start:end], np.asarray(labels)[start:end], sign)
+
+                p = expit(new_logits.T)
+                probs = np.dstack([1 - p, p])
+
+            yield start, probs
+
+
+"""
+Lookahead engine of a mode: NBLookahead for 'nb', InfluenceLookahead for 'influence'.
+"""
+def lookaheadEngine(lookahead, classifier, classifier_args, X, y):
+    if lookahead == 'influence':
+        return InfluenceLookahead(classifier, classifier_args, X, y)
+    return NBLookahead(classifier, classifier_args, X, y)
+
+ENGINES = ['nb', 'influence']
+
+
+"""
+Warm-started refits for iterative linear solvers.
+The model of a hypothetical training set differs from the current model by a single row, so
+starting the solver from the current coefficients usually converges in a few iterations.
+Only solvers that honour warm_start (LogisticRegression with newton-cg, lbfgs, sag or saga)
+benefit; the others fit from scratch, which learning_curve.py reports when the run starts.
+"""
+def supportsWarmStart(classifier, classifier_args=None):
+    params = classifier(**(classifier_args or {})).get_params()
+    # liblinear ignores warm_start
+    return 'warm_start' in params and params.get('solver') != 'liblinear'
+
+def warmStartFit(classifier, classifier_args, base_model, X, y, tol=None, max_iter=None, usable=None):
+    if usable is None:
+        usable = supportsWarmStart(classifier, classifier_args)
+    if base_model is None or not hasattr(base_model, 'coef_') or not usable:
+        model = classifier(**classifier_args)
+        model.fit(X, y)
+        return model
+
+    # set through the constructor, set_params costs as much as a small fit
+    args = dict(classifier_args, warm_start=True)
+    # starting close to the solution, a looser tolerance or fewer iterations may do
+    if tol is not None:
+        args['tol'] = tol
+    if max_iter is not None:
+        args['max_iter'] = max_iter
+    model = classifier(**args)
+    model.coef_ = base_model.coef_.copy()
+    model.intercept_ = np.copy(base_model.intercept_)
+    model.fit(X, y)
+    return model
+
+
+"""
+Warm-started lookahead fits of a trial, with their tolerance and iteration cap.
+Every check_every fits (0 never) the same set is also fit cold, and the gap between both
+models is recorded: largest difference of their probabilities on the evaluation set and
+relative distance of their coefficients. Classifiers without a usable warm start (e.g. SVC,
+or LogisticRegression with liblinear) are fit cold.
+"""
+class WarmStarter(object):
+
+    def __init__(self, tol=None, max_iter=None, check_every=0):
+        self.tol = tol
+        self.max_iter = max_iter
+        self.check_every = check_every
+        self.lock = threading.Lock()
+        self.fits = 0
+        self.checks = 0
+        self.prob_gaps = []
+        self.coef_gaps = []
+        # supportsWarmStart per classifier and arguments, it costs as much as a small fit
+        self.usable = {}
+
+    def fit(self, classifier, classifier_args, base_model, X, y, X_eval=None):
+        key = (classifier.__name__, repr(sorted(classifier_args.items())))
+        if not key in self.usable:
+            self.usable[key] = supportsWarmStart(classifier, classifier_args)
+        usable = self.usable[key]
+
+        model = warmStartFit(classifier, classifier_args, base_model, X, y, self.tol, self.max_iter, usable)
+
+        with self.lock:
+            self.fits += 1
+            check = self.check_every > 0 and X_eval is not None and self.fits % self.check_every == 0
+        # cold fits need no checking
+        check = check and base_model is not None and hasattr(base_model, 'coef_') and usable
+
+        if check:
+            with timers.phase('lookahead.warm_check'):
+                cold = classifier(**classifier_args)
+                cold.fit(X, y)
+                prob_gap = np.max(np.abs(model.predict_proba(X_eval) - cold.predict_proba(X_eval)))
+                coef_gap = np.nan
+                if hasattr(cold, 'coef_') and hasattr(model, 'coef_'):
+                    coef_gap = np.linalg.norm(model.coef_ - cold.coef_) / max(np.linalg.norm(cold.coef_), np.finfo(np.float64).tiny)
+            with self.lock:
+                self.checks += 1
+                self.prob_gaps.append(prob_gap)
+                self.coef_gaps.append(coef_gap)
+
+        return model
+
+    def report(self):
+        if not self.checks:
+            return "%d warm-started fits" % self.fits
+        return "%d warm-started fits, %d checked against a cold fit: probability gap max %.2e mean %.2e, relative coefficient gap max %.2e" % (
+            self.fits, self.checks, np.max(self.prob_gaps), np.mean(self.prob_gaps), np.nanmax(self.coef_gaps + [0.]))
+
+
+LOOKAHEADS = ['refit', 'nb', 'warm', 'influence']
+
+"""
+Validates the lookahead mode requested for a classifier, among the modes a strategy implements.
+'refit' fits a new classifier for every hypothetical training set, 'nb' uses NBLookahead,
+'warm' starts each fit from the solution of the current model (WarmStarter) and 'influence'
+uses InfluenceLookahead.
+"""
+def checkLookahead(lookahead, classifier, supported=LOOKAHEADS):
+    if not lookahead in LOOKAHEADS:
+        raise ValueError("Unknown lookahead: %s" % lookahead)
+    if not lookahead in supported:
+        raise ValueError("Lookahead %s is not available for this strategy, use one of %s" % (lookahead, ', '.join(supported)))
+    if lookahead == 'nb' and not classifier in (MultinomialNB, BernoulliNB):
+        raise ValueError("NB lookahead requires MultinomialNB or BernoulliNB, got %s" % classifier.__name__)
+    if lookahead == 'influence' and not classifier is LogisticRegression:
+        raise ValueError("Influence lookahead requires LogisticRegression, got %s" % classifier.__name__)
+    return lookahead
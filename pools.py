@@ -0,0 +1,94 @@
+'''
+Array-backed index sets for the pool of unlabeled instances.
+'''
+
+import numpy as np
+
+
+"""
+Set of indices in [0, n), e.g. the instances still in the pool.
+A boolean mask gives O(1) membership, and a compact array of the members, kept dense by
+swap-remove, gives O(k) removal and sampling of k members without touching the others.
+It supports the parts of the set API used by the strategies (len, iteration, in,
+difference_update), so code written for Python sets keeps working.
+"""
+class IndexPool(object):
+
+    def __init__(self, n, indices=None):
+        self.mask = np.zeros(n, dtype=bool)
+        self.items = np.empty(n, dtype=np.intp)
+        self.position = np.empty(n, dtype=np.intp)
+        self.size = 0
+
+        if indices is None:
+            indices = np.arange(n)
+        self.add(indices)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.items[:self.size].tolist())
+
+    def __contains__(self, i):
+        return 0 <= i < len(self.mask) and self.mask[i]
+
+    def indices(self):
+        """ Copy of the members, in the pool's internal order. """
+        return self.items[:self.size].copy()
+
+    def add(self, indices):
+        if not isinstance(indices, np.ndarray):
+            indices = np.array(list(indices), dtype=np.intp)
+        indices = indices.astype(np.intp)
+        if len(indices) == 0:
+            return
+        # drop duplicates and members, keeping the given order
+        _, first = np.unique(indices, return_index=True)
+        indices = indices[np.sort(first)]
+        indices = indices[~self.mask[indices]]
+
+        end = self.size + len(indices)
+        self.items[self.size:end] = indices
+        self.position[indices] = np.arange(self.size, end)
+        self.mask[indices] = True
+        self.size = end
+
+    def remove(self, indices):
+        for i in indices:
+            if not self.mask[i]:
+                continue
+            # move the last member into the hole left by i
+            pos = self.position[i]
+            last = self.items[self.size - 1]
+            self.items[pos] = last
+            self.position[last] = pos
+            self.mask[i] = False
+            self.size -= 1
+
+    def difference_update(self, indices):
+        self.remove(indices)
+
+    def _swap(self, a, b):
+        item_a = self.items[a]
+        item_b = self.items[b]
+        self.items[a] = item_b
+        self.items[b] = item_a
+        self.position[item_b] = a
+        self.position[item_a] = b
+
+    """
+    Draws k distinct members uniformly at random (all of them if k >= len(pool)).
+    Runs a partial Fisher-Yates shuffle over the first k slots, so it costs O(k);
+    when k is a large share of the pool a single vectorized permutation is cheaper.
+    """
+    def sample(self, k, randgen=np.random):
+        k = min(k, self.size)
+
+        if 4 * k > self.size:
+            order = randgen.permutation(self.size)[:k]
+            return self.items[order]
+
+        for j in xrange(k):
+            self._swap(j, randgen.randint(j, self.size))
+        return self.items[:k].copy()
@@ -0,0 +1,264 @@
+'''
+Learning-curve results: streaming writer, columnar store and mean/std/stderr tables.
+
+ResultsWriter appends one record per (strategy, trial, train size) as soon as it is measured,
+as JSON lines or CSV (chosen by the file extension), so runs can be followed live.
+ResultsStore holds the accuracies and aucs of many curves as (strategy, trial, train size)
+arrays, aggregated without Python loops over the values, and saved as .npz with metadata.
+Run as a script to merge such files into the tables written by learning_curve.py -f:
+
+    python results.py results.jsonl [more.npz ...] [-o summary.csv] [-z merged.npz] [-a]
+'''
+
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+
+import numpy as np
+
+
+FIELDS = ['strategy', 'trial', 'train_size', 'accuracy', 'auc']
+
+METRICS = ['accuracy', 'auc']
+
+
+class ResultsWriter(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.csv = filename.endswith('.csv')
+        self.doc = None
+        self.pid = None
+
+        if self.csv and not os.path.exists(filename):
+            with open(filename, 'w') as doc:
+                doc.write(','.join(FIELDS) + '\n')
+
+    def write(self, strategy, trial, train_size, accuracy, auc):
+        # Each process (e.g. the workers of --jobs) appends through its own line-buffered handle
+        if self.doc is None or self.pid != os.getpid():
+            self.doc = open(self.filename, 'a', 1)
+            self.pid = os.getpid()
+
+        if self.csv:
+            self.doc.write('%s,%d,%d,%r,%r\n' % (strategy, trial, train_size, float(accuracy), float(auc)))
+        else:
+            record = dict(zip(FIELDS, [strategy, trial, train_size, float(accuracy), float(auc)]))
+            self.doc.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def close(self):
+        if self.doc is not None:
+            self.doc.close()
+            self.doc = None
+
+
+"""
+Accuracies and aucs of learning curves, in arrays indexed by (strategy, trial, train size).
+The axes grow as new strategies, trials and train sizes are added, doubling their capacity
+when full; the steps a trial did not reach are nan.
+"""
+class ResultsStore(object):
+
+    def __init__(self, metadata=None):
+        # settings of the runs, saved along the values
+        self.metadata = dict(metadata or {})
+        # strategies, trials and train sizes, in the order they were added, and their positions
+        self.keys = ([], [], [])
+        self.positions = ({}, {}, {})
+        self.arrays = dict((metric, np.full((1, 1, 1), np.nan)) for metric in METRICS)
+
+    def position(self, axis, key):
+        positions = self.positions[axis]
+        if not key in positions:
+            positions[key] = len(self.keys[axis])
+            self.keys[axis].append(key)
+
+            capacity = self.arrays[METRICS[0]].shape[axis]
+            if positions[key] >= capacity:
+                for metric in METRICS:
+                    array = self.arrays[metric]
+                    shape = list(array.shape)
+                    shape[axis] = 2 * capacity
+                    grown = np.full(shape, np.nan)
+                    grown[tuple(slice(0, n) for n in array.shape)] = array
+                    self.arrays[metric] = grown
+        return positions[key]
+
+    def strategies(self):
+        return list(self.keys[0])
+
+    def add(self, strategy, trial, train_size, accuracy, auc):
+        """ A step written twice (e.g. recomputed after resuming a checkpoint) keeps its last values. """
+        index = (self.position(0, strategy), self.position(1, trial), self.position(2, train_size))
+        self.arrays['accuracy'][index] = accuracy
+        self.arrays['auc'][index] = auc
+
+    def addCurves(self, strategy, curves):
+        """ Adds the (train size, accuracy, auc) curves of learning(), one per trial in trial order. """
+        for trial, curve in enumerate(curves):
+            for train_size, accu, auc in curve:
+                self.add(strategy, trial, train_size, accu, auc)
+
+    def merge(self, other):
+        index = [[self.position(axis, key) for key in other.keys[axis]] for axis in range(3)]
+        cells = np.ix_(*index)
+        for metric in METRICS:
+            values = other.arrays[metric][:len(index[0]), :len(index[1]), :len(index[2])]
+            block = self.arrays[metric][cells]
+            present = ~np.isnan(values)
+            block[present] = values[present]
+            self.arrays[metric][cells] = block
+
+    def values(self, strategy, metric):
+        """
+        The train sizes strategy reached, in order, and its values of metric: an array of
+        trials (the ones with any value, in trial order) by those train sizes.
+        """
+        values = self.arrays[metric][self.positions[0][strategy], :len(self.keys[1]), :len(self.keys[2])]
+        missing = np.isnan(values)
+
+        trials = np.argsort(self.keys[1], kind='mergesort')
+        trials = trials[~np.all(missing[trials], axis=1)]
+        sizes = np.argsort(self.keys[2], kind='mergesort')
+        sizes = sizes[~np.all(missing[:, sizes], axis=0)]
+
+        return np.array(self.keys[2])[sizes], values[np.ix_(trials, sizes)]
+
+    def trainSizes(self, strategy):
+        return self.values(strategy, METRICS[0])[0]
+
+    def numTrials(self, strategy):
+        return self.values(strategy, METRICS[0])[1].shape[0]
+
+    """
+    Mean, standard deviation and standard error per train size, over the trials that reached it.
+    As in the original tables, -inf (a training set with a single class) counts as 0 in the
+    standard deviation but is kept in the mean. The standard error divides by num_trials
+    (default: the trials of strategy).
+    """
+    def summary(self, strategy, metric, num_trials=None):
+        sizes, values = self.values(strategy, metric)
+        if num_trials is None:
+            num_trials = values.shape[0]
+
+        # one train size per row, so each is reduced in the same order as a list of its values
+        values = np.ascontiguousarray(values.T)
+        mean = np.nanmean(values, axis=1)
+        std = np.nanstd(np.where(np.isinf(values), 0, values), axis=1)
+        return sizes, mean, std, std / math.sqrt(num_trials)
+
+    """
+    Area under the learning curve of metric of each trial of strategy (trapezoidal rule over
+    the train sizes), divided by the span of train sizes, i.e. the mean of metric over the
+    curve. Trials that missed a train size get nan.
+    """
+    def aulc(self, strategy, metric):
+        sizes, values = self.values(strategy, metric)
+        if len(sizes) < 2:
+            return values[:, 0] if len(sizes) else np.empty(0)
+        return np.trapz(values, sizes, axis=1) / float(sizes[-1] - sizes[0])
+
+    def writeSummary(self, doc, strategy, num_trials=None):
+        # Saves all accuracies into a file
+        x, y, z, e = self.summary(strategy, 'accuracy', num_trials)
+        doc.write(strategy+'\n'+'accuracy'+'\n')
+        doc.write('train size,mean,standard deviation,standard error'+'\n')
+        for i in range(len(y)):
+            doc.write("%d,%f,%f,%f\n" % (x[i], y[i], z[i], e[i]))
+        doc.write('\n')
+
+        # Saves all acus into a file
+        x, y, z, e = self.summary(strategy, 'auc', num_trials)
+        doc.write('AUC'+'\n')
+        doc.write('train size,mean,standard deviation,standard error'+'\n')
+        for i in range(len(y)):
+            doc.write("%d,%f,%f,%f\n" % (x[i], y[i], z[i], e[i]))
+        doc.write('\n\n\n')
+
+    def save(self, filename):
+        """ Saves the arrays and keys as .npz, with the metadata as JSON. """
+        used = tuple(slice(0, len(keys)) for keys in self.keys)
+        np.savez_compressed(filename, accuracy=self.arrays['accuracy'][used], auc=self.arrays['auc'][used],
+                            strategies=np.array(self.keys[0], dtype=str), trials=np.array(self.keys[1], dtype=np.int64),
+                            train_sizes=np.array(self.keys[2], dtype=np.int64), metadata=np.array(json.dumps(self.metadata, sort_keys=True)))
+
+    @classmethod
+    def load(cls, filename):
+        arrays = np.load(filename)
+        try:
+            store = cls(json.loads(str(arrays['metadata'])))
+            store.keys = ([str(strategy) for strategy in arrays['strategies']], arrays['trials'].tolist(), arrays['train_sizes'].tolist())
+            store.positions = tuple(dict((key, i) for i, key in enumerate(keys)) for keys in store.keys)
+            store.arrays = dict((metric, arrays[metric].copy()) for metric in METRICS)
+        finally:
+            arrays.close()
+
+        if min(store.arrays['accuracy'].shape) == 0:
+            # an empty store grows from one cell per axis
+            store = cls(store.metadata)
+        return store
+
+    @classmethod
+    def read(cls, filename):
+        """ Store of a file written by ResultsWriter, or saved by save (.npz). """
+        if filename.endswith('.npz'):
+            return cls.load(filename)
+
+        store = cls()
+        with open(filename) as doc:
+            if filename.endswith('.csv'):
+                rows = csv.DictReader(doc)
+            else:
+                rows = (json.loads(line) for line in doc if line.strip())
+
+            for row in rows:
+                store.add(row['strategy'], int(row['trial']), int(row['train_size']), float(row['accuracy']), float(row['auc']))
+        return store
+
+
+if (__name__ == '__main__'):
+
+    parser = argparse.ArgumentParser(description='Aggregates streamed learning-curve results into mean/std/stderr tables.')
+
+    parser.add_argument("results", nargs='+',
+                        help='Files written by learning_curve.py --stream (.jsonl or .csv) or --results_store (.npz), merged in order.')
+
+    parser.add_argument("-o", "--output", type=str, default='',
+                        help='File the tables are written to. If it is left blank, they are printed (default: '' ).')
+
+    parser.add_argument("-z", "--npz", type=str, default='',
+                        help='File the merged results are saved to as a ResultsStore (.npz) (default: '' ).')
+
+    parser.add_argument("-a", "--aulc", action='store_true',
+                        help='Also print the mean and standard error of the area under the learning curves of each strategy.')
+
+    args = parser.parse_args()
+
+    store = ResultsStore.read(args.results[0])
+    for filename in args.results[1:]:
+        store.merge(ResultsStore.read(filename))
+
+    doc = sys.stdout
+    if args.output:
+        doc = open(args.output, 'w')
+
+    for strategy in store.strategies():
+        store.writeSummary(doc, strategy)
+
+    if args.output:
+        doc.close()
+
+    if args.npz:
+        store.save(args.npz)
+
+    if args.aulc:
+        print "%-30s%20s%20s" % ('Strategy', 'Accuracy AULC', 'AUC AULC')
+        for strategy in store.strategies():
+            columns = []
+            for metric in METRICS:
+                areas = store.aulc(strategy, metric)
+                columns.append("%0.4f +- %0.4f" % (np.mean(areas), np.std(areas) / math.sqrt(max(len(areas), 1))))
+            print "%-30s%20s%20s" % (strategy, columns[0], columns[1])
@@ -0,0 +1,324 @@
+'''
+Work-queue runner for grids of learning-curve experiments.
+
+A grid spec (JSON) maps settings of learning_curve.py to lists of values, plus num_trials:
+
+    {"data": [["data/imdb-binary-pool-mindf5-ng11", "data/imdb-binary-test-mindf5-ng11"]],
+     "classifier": ["MultinomialNB", "LogisticRegression"], "strategy": ["rand", "unc", "s1"],
+     "budget": [500], "stepsize": [10], "num_trials": 10}
+
+A data entry is a (pool, test) pair, or a single file to split. Settings left out take the
+defaults of learning_curve.py. "init" expands the grid into one task per (settings, trial),
+as files of <queue>/pending. Any number of "work" processes, on any host sharing the queue
+directory, claim tasks by renaming them into running/ (atomic, so each task runs once), run the
+trial and write its curve to results/ before moving the task to done/. A claimed task records
+its worker, which touches it every HEARTBEAT seconds while it runs. Tasks are named by a
+hash of their contents, so adding a grid again or rerunning a task is harmless, and "requeue"
+puts failed and stale (no longer touched) tasks back. "merge" gathers the results into one file and its tables.
+
+    python runner.py init queue grid.json
+    python runner.py work queue -w 4
+    python runner.py merge queue -o results.jsonl -s summary.csv
+'''
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import socket
+import threading
+import traceback
+
+from multiprocessing import Process
+from time import time
+
+import learning_curve
+
+from datacache import atomicWrite
+from learning_curve import learningTrial, classifierArguments, loadData
+from results import ResultsStore, ResultsWriter
+
+
+# Settings of a task and their learning_curve.py defaults
+DEFAULTS = {'data': ["data/imdb-binary-pool-mindf5-ng11", "data/imdb-binary-test-mindf5-ng11"], 'classifier': 'MultinomialNB',
+            'arguments': '', 'strategy': 'rand', 'budget': 500, 'stepsize': 10, 'subpool': 250, 'bootstrap': 10, 'm': 0,
+            'p': ['log'], 'makeitbetter': False, 'lookahead': 'refit'}
+
+STATES = ['pending', 'running', 'done', 'failed']
+
+# Seconds between the touches of a running task by its worker
+HEARTBEAT = 60
+
+
+def expandGrid(spec):
+    keys = sorted(DEFAULTS)
+    values = []
+    for key in keys:
+        values.append(spec.get(key, [DEFAULTS[key]]))
+
+    unknown = set(spec) - set(keys) - set(['num_trials'])
+    if unknown:
+        raise ValueError("Unknown settings in the grid: %s" % ', '.join(sorted(unknown)))
+
+    tasks = []
+    for combination in itertools.product(*values):
+        settings = dict(zip(keys, combination))
+        for t in range(spec.get('num_trials', 10)):
+            tasks.append({'settings': settings, 'trial': t})
+    return tasks
+
+def taskName(task):
+    return hashlib.sha1(json.dumps(task, sort_keys=True)).hexdigest()[:16]
+
+"""
+Name of the experiment (all the settings but the trial) the results of a task are filed under.
+"""
+def experimentName(settings):
+    return ' '.join('%s=%s' % (key, json.dumps(settings[key])) for key in sorted(settings))
+
+
+class WorkQueue(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        # written into the tasks this process claims
+        self.worker = '%s:%d' % (socket.gethostname(), os.getpid())
+        for name in STATES + ['results']:
+            path = os.path.join(directory, name)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # another worker made it first
+                    if not os.path.isdir(path):
+                        raise
+
+    def path(self, state, name):
+        return os.path.join(self.directory, state, name)
+
+    def _write(self, path, content):
+        def writeContent(tmp):
+            with open(tmp, 'w') as f:
+                f.write(content)
+        atomicWrite(path, writeContent)
+
+    def add(self, tasks):
+        added = 0
+        for task in tasks:
+            name = taskName(task) + '.json'
+            if any(os.path.exists(self.path(state, name)) for state in STATES):
+                continue
+            self._write(self.path('pending', name), json.dumps(task, sort_keys=True))
+            added += 1
+        return added
+
+    def claim(self):
+        for name in sorted(os.listdir(os.path.join(self.directory, 'pending'))):
+            if name.startswith('.'):
+                continue
+            try:
+                os.rename(self.path('pending', name), self.path('running', name))
+            except OSError:
+                # claimed by another worker
+                continue
+            with open(self.path('running', name)) as f:
+                task = json.load(f)
+            # a requeued task still names its previous worker
+            task.pop('worker', None)
+            # the claim (and heartbeat) time tells stale tasks apart
+            self._write(self.path('running', name), json.dumps(dict(task, worker=self.worker), sort_keys=True))
+            return name, task
+        return None, None
+
+    def owner(self, name):
+        """ Worker that claimed the running task name, None if it is not running. """
+        try:
+            with open(self.path('running', name)) as f:
+                return json.load(f).get('worker')
+        except IOError:
+            return None
+
+    def heartbeat(self, name):
+        if self.owner(name) == self.worker:
+            try:
+                os.utime(self.path('running', name), None)
+            except OSError:
+                pass
+
+    def complete(self, name, task, curve):
+        experiment = experimentName(task['settings'])
+        def writeCurve(tmp):
+            writer = ResultsWriter(tmp)
+            for size, accu, auc in curve:
+                writer.write(experiment, task['trial'], size, accu, auc)
+            writer.close()
+        atomicWrite(self.path('results', name.replace('.json', '.jsonl')), writeCurve)
+        return self._release(name, 'done')
+
+    def fail(self, name, error):
+        self._write(self.path('failed', name.replace('.json', '.log')), error)
+        return self._release(name, 'failed')
+
+    def _release(self, name, state):
+        """ Moves a task of this worker out of running/, False if it is no longer its own. """
+        if self.owner(name) != self.worker:
+            return False
+        try:
+            os.rename(self.path('running', name), self.path(state, name))
+        except OSError:
+            # requeued as stale meanwhile (and maybe claimed again), so someone else owns it now
+            return False
+        return True
+
+    def requeue(self, stale=None):
+        moved = 0
+        for name in os.listdir(os.path.join(self.directory, 'failed')):
+            if name.endswith('.json'):
+                os.rename(self.path('failed', name), self.path('pending', name))
+                moved += 1
+        if stale is not None:
+            for name in os.listdir(os.path.join(self.directory, 'running')):
+                if name.endswith('.json') and time() - os.path.getmtime(self.path('running', name)) > stale:
+                    os.rename(self.path('running', name), self.path('pending', name))
+                    moved += 1
+        return moved
+
+    def counts(self):
+        return dict((state, len([name for name in os.listdir(os.path.join(self.directory, state)) if name.endswith('.json')])) for state in STATES)
+
+    def merge(self, output):
+        with open(output, 'w') as doc:
+            for name in sorted(os.listdir(os.path.join(self.directory, 'results'))):
+                if name.endswith('.jsonl'):
+                    with open(self.path('results', name)) as f:
+                        doc.write(f.read())
+
+
+# Data sets loaded by this worker, keyed by their files
+_data = {}
+
+def runTask(task, cache_dir=''):
+    settings = task['settings']
+
+    key = json.dumps(settings['data'])
+    if not key in _data:
+        if isinstance(settings['data'], list):
+            _data[key] = loadData(settings['data'], cache_dir=cache_dir)
+        else:
+            _data[key] = loadData(None, settings['data'], cache_dir)
+    X_pool, y_pool, X_test, y_test = _data[key]
+
+    classifier = getattr(learning_curve, settings['classifier'])
+    alpha = classifierArguments(settings['arguments'])
+
+    # as in learning_curve.py, a single -p value is for strategies 1 and 2
+    s_parameter = settings['p']
+    if len(s_parameter) == 1:
+        s_parameter = s_parameter[0]
+
+    options = {'lookahead': settings['lookahead']}
+
+    return learningTrial(task['trial'], X_pool, y_pool, X_test, settings['strategy'], settings['budget'], settings['stepsize'], settings['subpool'],
+                         settings['bootstrap'], classifier, alpha, y_test, settings['m'], s_parameter, settings['makeitbetter'], options)
+
+"""
+Touches the running task name every HEARTBEAT seconds until finished is set, so "requeue -s"
+only takes the tasks of workers that died.
+"""
+def keepAlive(queue, name, finished):
+    while not finished.wait(HEARTBEAT):
+        queue.heartbeat(name)
+
+def work(directory, cache_dir=''):
+    queue = WorkQueue(directory)
+    worker = queue.worker
+
+    while True:
+        name, task = queue.claim()
+        if name is None:
+            break
+
+        print worker, "running", name, experimentName(task['settings']), "trial", task['trial']
+        finished = threading.Event()
+        heartbeat = threading.Thread(target=keepAlive, args=(queue, name, finished))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            curve = runTask(task, cache_dir)
+        except Exception:
+            if not queue.fail(name, traceback.format_exc()):
+                print worker, "lost", name, "to a requeue"
+            print worker, "failed", name
+            continue
+        finally:
+            finished.set()
+        if not queue.complete(name, task, curve):
+            print worker, "lost", name, "to a requeue, its results are kept"
+
+
+if (__name__ == '__main__'):
+
+    parser = argparse.ArgumentParser(description='Runs grids of learning-curve experiments from a work queue directory.')
+    commands = parser.add_subparsers(dest='command')
+
+    init = commands.add_parser('init', help='Adds the tasks of a grid spec to the queue.')
+    init.add_argument("queue", help='Queue directory.')
+    init.add_argument("spec", help='JSON grid spec.')
+
+    worker = commands.add_parser('work', help='Runs tasks of the queue until it is empty.')
+    worker.add_argument("queue", help='Queue directory.')
+    worker.add_argument("-w", "--workers", default=1, type=int, help='Number of worker processes (default: 1).')
+    worker.add_argument("-cd", '--cache_dir', type=str, default='',
+                        help='Directory where the svmlight files are cached in binary form (default: '' ).')
+
+    requeue = commands.add_parser('requeue', help='Puts failed tasks, and optionally stale running ones, back in the queue.')
+    requeue.add_argument("queue", help='Queue directory.')
+    requeue.add_argument("-s", "--stale", default=None, type=float,
+                         help='Also requeue the running tasks not touched for this many seconds (their workers touch them every \
+                         %d), e.g. on a host that died.' % HEARTBEAT)
+
+    merge = commands.add_parser('merge', help='Gathers the results of the finished tasks.')
+    merge.add_argument("queue", help='Queue directory.')
+    merge.add_argument("-o", "--output", type=str, default='results.jsonl',
+                       help='File the results of all tasks are written to (default: results.jsonl).')
+    merge.add_argument("-s", "--summary", type=str, default='',
+                       help='File the mean/std/stderr tables per experiment are written to (default: '' ).')
+
+    commands.add_parser('status', help='Counts the tasks in each state.').add_argument("queue", help='Queue directory.')
+
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        with open(args.spec) as f:
+            spec = json.load(f)
+        tasks = expandGrid(spec)
+        added = WorkQueue(args.queue).add(tasks)
+        print "%d tasks, %d added to %s" % (len(tasks), added, args.queue)
+
+    elif args.command == 'work':
+        workers = [Process(target=work, args=(args.queue, args.cache_dir)) for i in range(args.workers)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+    elif args.command == 'requeue':
+        print "%d tasks requeued" % WorkQueue(args.queue).requeue(args.stale)
+
+    elif args.command == 'merge':
+        queue = WorkQueue(args.queue)
+        queue.merge(args.output)
+        counts = queue.counts()
+        if counts['pending'] or counts['running'] or counts['failed']:
+            print "Warning: %d tasks pending, %d running and %d failed" % (counts['pending'], counts['running'], counts['failed'])
+
+        if args.summary:
+            store = ResultsStore.read(args.output)
+            with open(args.summary, 'w') as doc:
+                for experiment in store.strategies():
+                    store.writeSummary(doc, experiment)
+
+    elif args.command == 'status':
+        counts = WorkQueue(args.queue).counts()
+        print ', '.join('%s: %d' % (state, counts[state]) for state in STATES)
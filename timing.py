@@ -0,0 +1,64 @@
+'''
+Per-phase timing of the learning loop and the strategies.
+
+Code under measurement runs inside "with timers.phase(name):"; the module-level timers
+accumulates the wall time and number of calls of each phase. Phases nest: chooseNext
+includes the sampling, fits, predictions and utilities of the strategy, so the time of
+chooseNext not covered by its sub-phases is Python overhead.
+Phases run inside process-executor workers are not counted.
+'''
+
+import json
+import threading
+
+from collections import defaultdict
+from contextlib import contextmanager
+from time import time
+
+
+class PhaseTimer(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.totals = defaultdict(lambda: 0.0)
+        self.calls = defaultdict(lambda: 0)
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time()
+        try:
+            yield
+        finally:
+            elapsed = time() - t0
+            # executor threads report concurrently
+            with self.lock:
+                self.totals[name] += elapsed
+                self.calls[name] += 1
+
+    def snapshot(self):
+        return dict((name, {'time': self.totals[name], 'calls': self.calls[name]}) for name in self.totals)
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, phase in snapshot.items():
+                self.totals[name] += phase['time']
+                self.calls[name] += phase['calls']
+
+
+def summary(snapshot):
+    lines = ["%-26s%8s%12s%12s" % ('Phase', 'Calls', 'Total (s)', 'Mean (ms)')]
+    for name in sorted(snapshot, key=lambda name: -snapshot[name]['time']):
+        phase = snapshot[name]
+        lines.append("%-26s%8d%12.3f%12.3f" % (name, phase['calls'], phase['time'], 1000. * phase['time'] / max(phase['calls'], 1)))
+    return '\n'.join(lines)
+
+def dump(snapshots, filename):
+    with open(filename, 'w') as doc:
+        json.dump(snapshots, doc, indent=2, sort_keys=True)
+
+
+# Timer shared by the learning loop and the strategies of this process
+timers = PhaseTimer()
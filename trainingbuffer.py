@@ -0,0 +1,124 @@
+'''
+Append-only training matrix.
+
+The training set of a trial only grows, one step (or one lookahead candidate) at a time, yet
+X[train_indices] copies all its rows again each time. TrainingBuffer keeps the rows of the
+training set in arrays with spare capacity, doubled when full, so adding rows only copies the
+new ones, and the training matrix is a view of the arrays. Sparse sources are stored as CSR,
+dense ones (GaussianNB) as a 2-d array.
+'''
+
+import numpy as np
+import scipy.sparse as ss
+
+
+class TrainingBuffer(object):
+
+    def __init__(self, X, capacity=64):
+        # the matrix the rows are taken from, as given
+        self.source = X
+        self.sparse = ss.issparse(X)
+        if self.sparse:
+            X = X.tocsr()
+        self.X = X
+        self.allocate(capacity, max(capacity * self.rowSize(), 1))
+
+    def rowSize(self):
+        if not self.sparse or self.X.shape[0] == 0:
+            return 1
+        return int(np.ceil(float(self.X.nnz) / self.X.shape[0]))
+
+    def allocate(self, rows, nnz):
+        # fresh arrays, so the views handed out before (e.g. kept by a fitted model) stay valid
+        self.rows = np.empty(rows, dtype=np.intp)
+        self.y = None
+        self.size = 0
+        self.nnz = 0
+        if self.sparse:
+            self.data = np.empty(nnz, dtype=self.X.data.dtype)
+            self.indices = np.empty(nnz, dtype=self.X.indices.dtype)
+            self.indptr = np.zeros(rows + 1, dtype=self.X.indptr.dtype)
+        else:
+            self.dense = np.empty((rows, self.X.shape[1]), dtype=self.X.dtype)
+
+    def reserve(self, rows, nnz):
+        """ Room for rows more rows with nnz more non-zeros, growing the arrays by doubling. """
+        if self.size + rows > len(self.rows):
+            capacity = max(2 * len(self.rows), self.size + rows)
+            self.rows = np.resize(self.rows, capacity)
+            if self.y is not None:
+                self.y = np.resize(self.y, capacity)
+            if self.sparse:
+                self.indptr = np.resize(self.indptr, capacity + 1)
+            else:
+                dense = np.empty((capacity, self.X.shape[1]), dtype=self.X.dtype)
+                dense[:self.size] = self.dense[:self.size]
+                self.dense = dense
+
+        if self.sparse and self.nnz + nnz > len(self.data):
+            capacity = max(2 * len(self.data), self.nnz + nnz)
+            self.data = np.resize(self.data, capacity)
+            self.indices = np.resize(self.indices, capacity)
+
+    def write(self, rows, labels):
+        """ Writes rows and their labels after the last row, without counting them in. """
+        rows = np.asarray(rows, dtype=np.intp)
+        labels = np.asarray(labels)
+        if self.y is None:
+            self.y = np.empty(len(self.rows), dtype=labels.dtype)
+
+        if self.sparse:
+            starts = self.X.indptr[rows]
+            lengths = self.X.indptr[rows + 1] - starts
+            total = int(lengths.sum())
+            self.reserve(len(rows), total)
+
+            # positions in X of the non-zeros of rows, in order
+            offsets = np.cumsum(lengths) - lengths
+            gather = np.repeat(starts - offsets, lengths) + np.arange(total)
+            self.data[self.nnz:self.nnz + total] = self.X.data[gather]
+            self.indices[self.nnz:self.nnz + total] = self.X.indices[gather]
+            self.indptr[self.size + 1:self.size + len(rows) + 1] = self.nnz + np.cumsum(lengths)
+        else:
+            total = 0
+            self.reserve(len(rows), 0)
+            self.dense[self.size:self.size + len(rows)] = self.X[rows]
+
+        self.rows[self.size:self.size + len(rows)] = rows
+        self.y[self.size:self.size + len(rows)] = labels
+        return len(rows), total
+
+    def append(self, rows, labels):
+        num_rows, nnz = self.write(rows, labels)
+        self.size += num_rows
+        self.nnz += nnz
+
+    def sync(self, indices, labels):
+        """
+        Makes the buffer hold the rows indices of X with their labels: the rows past the ones
+        it holds are appended, and if those are not a prefix of indices, it starts over.
+        """
+        indices = np.asarray(indices, dtype=np.intp)
+        if len(indices) < self.size or not np.array_equal(indices[:self.size], self.rows[:self.size]):
+            self.allocate(max(len(self.rows), len(indices)), len(self.data) if self.sparse else 0)
+        if len(indices) > self.size:
+            self.append(indices[self.size:], np.asarray(labels)[self.size:])
+
+    def matrix(self, num_rows):
+        if self.sparse:
+            return ss.csr_matrix((self.data[:self.indptr[num_rows]], self.indices[:self.indptr[num_rows]], self.indptr[:num_rows + 1]),
+                                 shape=(num_rows, self.X.shape[1]), copy=False)
+        return self.dense[:num_rows]
+
+    def view(self):
+        """ The training matrix and labels, as views of the buffer. """
+        y = self.y[:self.size] if self.y is not None else np.empty(0)
+        return self.matrix(self.size), y
+
+    def extended(self, row, label):
+        """
+        The training matrix and labels with one more row of X, written in the spare capacity.
+        The views are only valid until the next call to extended or append.
+        """
+        self.write([row], [label])
+        return self.matrix(self.size + 1), self.y[:self.size + 1]
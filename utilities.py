@@ -0,0 +1,87 @@
+'''
+Vectorized utility functions shared by the strategies.
+
+probs is a (samples x classes) array as returned by predict_proba and labels are used
+as column indices, as the strategies assume binary 0/1 labels.
+Probabilities are clipped to the smallest positive float before taking logs, so a zero
+probability gives a large finite penalty instead of -inf/nan.
+'''
+
+import numpy as np
+from scipy.special import xlogy
+from sklearn import metrics
+
+TINY = np.finfo(np.float64).tiny
+
+
+def log_gain(probs, labels):
+    """ Sum of the log probabilities of the true labels. """
+    probs = np.asarray(probs)
+    labels = np.asarray(labels).astype(int)
+    return np.sum(np.log(np.maximum(probs[np.arange(len(labels)), labels], TINY)))
+
+def expected_log_loss(probs):
+    """ Mean entropy of the predictions, 0*log(0) counting as 0. """
+    probs = np.asarray(probs)
+    return -np.sum(xlogy(probs, probs)) / (len(probs) * 1.)
+
+def accuracy(probs, labels, classes):
+    pred_y = np.asarray(classes)[np.argmax(probs, axis=1)]
+    return np.mean(pred_y == np.asarray(labels))
+
+def auc(probs, labels):
+    """ ROC AUC, probabilities equal up to rounding (e.g. of a refit and a lookahead) being ties. """
+    return metrics.roc_auc_score(labels, np.round(np.asarray(probs)[:, 1], 10))
+
+
+"""
+Scores the predictions of a model on the test set, using log gain, AUC or accuracy.
+"""
+def utility(probs, y_test, option='log', classes=None):
+    if option == 'log':
+        return log_gain(probs, y_test)
+    elif option == 'auc':
+        return auc(probs, y_test)
+    elif option == 'accu':
+        return accuracy(probs, y_test, classes)
+    raise ValueError("Unknown utility: %s" % option)
+
+
+"""
+Uncertainty of the predictions of a model, per sample, higher meaning more uncertain:
+the smallest class probability (minprob), minus the gap between the two most likely
+classes (margin) or the entropy of the prediction (entropy).
+"""
+def uncertainty(probs, measure='minprob'):
+    probs = np.asarray(probs)
+    if measure == 'minprob':
+        return np.min(probs, axis=1)
+    elif measure == 'margin':
+        top = np.sort(probs, axis=1)
+        return top[:, -2] - top[:, -1]
+    elif measure == 'entropy':
+        return -np.sum(xlogy(probs, probs), axis=1)
+    raise ValueError("Unknown uncertainty: %s" % measure)
+
+
+"""
+Committee disagreement, predictions being stacked as (committee x candidates).
+"""
+def vote_entropy(predictions):
+    """ Entropy (in bits) of the hard votes of the committee, per candidate. """
+    predictions = np.asarray(predictions)
+    entropy = np.zeros(predictions.shape[1])
+    for label in np.unique(predictions):
+        votes = np.mean(predictions == label, axis=0)
+        entropy -= xlogy(votes, votes) / np.log(2)
+    return entropy
+
+def kl_disagreement(probs):
+    """
+    Soft-vote disagreement: mean KL divergence of each member's predicted distribution
+    from the committee's average, probs being (committee x candidates x classes).
+    """
+    probs = np.asarray(probs)
+    consensus = np.mean(probs, axis=0)
+    divergences = np.sum(xlogy(probs, probs) - xlogy(probs, np.maximum(consensus, TINY)), axis=2)
+    return np.mean(divergences, axis=0)
@@ -0,0 +1,71 @@
+'''
+Memoized test-set utilities of training sets.
+
+makeItBetter, the simulated annealing between strategies 1 and 2 and repeated trials often
+fit and score the same training set more than once. UtilityCache keeps the utilities of the
+most recently scored sets, keyed by a hash of their contents (sorted indices with their
+labels, classifier, arguments and metric), and evicts the least recently used beyond max_size.
+Hits and misses are counted per strategy by the utility_cache.hit and utility_cache.miss phases.
+Classifiers whose fit draws from the global random state (e.g. RandomForestClassifier without
+random_state) give cached runs that differ from uncached ones.
+'''
+
+import copy
+import hashlib
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+
+from timing import timers
+
+
+class UtilityCache(object):
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # indices of different pools (e.g. trials reducing the data with -m) must not collide
+        self.namespace = ''
+
+    def scoped(self, namespace):
+        """ View sharing the entries, whose keys are kept apart by namespace. """
+        view = copy.copy(self)
+        view.namespace = namespace
+        return view
+
+    def key(self, train_indices, labels, classifier, classifier_args, option):
+        train_indices = np.asarray(train_indices, dtype=np.int64)
+        order = np.argsort(train_indices, kind='mergesort')
+        digest = hashlib.sha1()
+        digest.update(self.namespace)
+        digest.update(train_indices[order].tostring())
+        digest.update(np.asarray(labels, dtype=np.float64)[order].tostring())
+        digest.update('%s|%r|%s' % (classifier.__name__, sorted(classifier_args.items()), option))
+        return digest.hexdigest()
+
+    def get(self, key, compute):
+        """ The utility stored under key, or compute() stored under it. """
+        with self.lock:
+            if key in self.entries:
+                # most recently used go last
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                found = True
+            else:
+                found = False
+
+        if found:
+            with timers.phase('utility_cache.hit'):
+                return value
+
+        with timers.phase('utility_cache.miss'):
+            value = compute()
+
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return value